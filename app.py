@@ -5,18 +5,32 @@ from io import StringIO
 import csv
 import os
 from itertools import groupby
+from functools import wraps
 from datetime import timedelta
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from urllib.parse import urlencode
 
-from quart import Quart, redirect, render_template, request, Response, make_response
+from quart import (
+    Quart, redirect, render_template, request, Response, after_this_request)
 from sqlalchemy.future import select
 from quart_cors import cors
 from sqlalchemy.orm import undefer, aliased
 
 from models import mbconfig, text_index_langs, postgres_language_configurations
 from models.models import Node, Brain, Link, Attachment, AttachmentType
+from models.prefetch import prefetcher
+from models.scheduler import scheduler
+from models.cache import response_cache, CachedResponse, make_etag, http_date, modified_since
+from models.surrogate import surrogate_headers
+from models.bus import bus
 from models.utils import (
-    get_brain, get_node, add_brain, convert_link, LINK_RE, get_session_maker,
-    resolve_html_links, httpx_client)
+    get_brain, get_node, get_nodes, add_brain, convert_link, LINK_RE,
+    resolve_html_links, httpx_client, load_brain_cache, shared_session_maker,
+    wait_background_tasks, upstream, cache_writer, spawn, UUID_RE)
+from models.upstream import UpstreamUnavailable
+from models.limits import admission, Overloaded
+from models.graph_index import graph_index, neighbour_page, node_gate_counts, top_node_id
+from models.traversal import find_path, subgraph, neighbour_summaries, RELATIONS
 
 
 
@@ -31,28 +45,98 @@ if os.environ.get('QUART_ENV') == 'development':
 
 
 class SQLAMiddleware:
+    "Closes the session that a request opened with db_session(), if any."
 
     def __init__(self, app):
         self.app = app
-        self.sessions = get_session_maker(expire_on_commit=False)
+        self.sessions = shared_session_maker()
 
     async def __call__(self, scope, receive, send):
-        session = self.sessions()
-        scope['session'] = session
         try:
             return await self.app(scope, receive, send)
         except Exception as e:
-            await session.rollback()
+            if 'session' in scope:
+                await scope['session'].rollback()
             raise e from e
         finally:
-            await session.close()
+            if 'session' in scope:
+                await scope.pop('session').close()
 
-app.asgi_app = SQLAMiddleware(app.asgi_app)
+sqla = SQLAMiddleware(app.asgi_app)
+app.asgi_app = sqla
 cors(app)
 
+
+def db_session():
+    "The request's session, created on first use."
+    if 'session' not in request.scope:
+        request.scope['session'] = sqla.sessions()
+    return request.scope['session']
+
+
+@app.before_serving
+async def startup():
+    async with sqla.sessions() as session:
+        await load_brain_cache(session)
+    if bus:
+        bus.start()
+    if scheduler:
+        scheduler.start()
+    if cache_writer:
+        cache_writer.start(spawn)
+    if graph_index:
+        spawn(graph_index.start())
+
+
+@app.after_serving
+async def shutdown():
+    if scheduler:
+        await scheduler.stop()
+    if cache_writer:
+        await cache_writer.stop()
+    if bus:
+        await bus.stop()
+    await wait_background_tasks()
+
+
+@app.errorhandler(UpstreamUnavailable)
+async def upstream_unavailable(error):
+    return Response("TheBrain is not answering, and this is not cached yet",
+                    status=503, headers={'Retry-After': '30'})
+
+
+@app.errorhandler(Overloaded)
+async def overloaded(error):
+    return Response("Too busy, please try again shortly", status=503, headers={'Retry-After': '5'})
+
+
+def admitted(budget):
+    "Run the route within a concurrency budget of admission control."
+    def decorator(route):
+        if not admission:
+            return route
+
+        @wraps(route)
+        async def admitted_route(*args, **kwargs):
+            async with admission[budget]:
+                return await route(*args, **kwargs)
+        return admitted_route
+    return decorator
+
+
+def mark_if_stale(node):
+    if not node.served_stale:
+        return
+
+    @after_this_request
+    async def add_stale_headers(response):
+        response.headers['Warning'] = '110 - "Response is Stale"'
+        response.headers['X-Cache-Status'] = 'stale'
+        return response
+
 @app.route("/")
 async def home():
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, mbconfig['default_brain'])
     if not brain or not brain.base_id:
         return Response(status=404)
@@ -65,7 +149,7 @@ BRAIN_URL_RE = re.compile(
 
 @app.route("/brain")
 async def list_brains():
-    session = request.scope['session']
+    session = db_session()
     brains = await session.execute(select(Brain))
     brains = [x for (x,) in brains]
     return await render_template(
@@ -74,31 +158,78 @@ async def list_brains():
 
 @app.route("/brain/<brain_slug>")
 async def base_brain(brain_slug):
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, brain_slug)
     if not brain:
         return Response("No such brain", status=404)
     # TODO: check if the brain really exists. Record failure in DB otherwise
-    if request.accept_mimetypes.best != 'application/json':
-        node_id = brain.base_id or brain.top_node_id(session)
+    mimetype = request.args.get("mimetype", request.accept_mimetypes.best)
+    if mimetype not in ('application/json', 'application/x-ndjson'):
+        node_id = brain.base_id or await top_node_id(session, brain)
         return redirect(f'/brain/{brain.safe_slug}/thought/{node_id}', code=302)
-    nodes = await session.execute(select(Node.data).filter_by(brain_id=brain.id, private=False))
-    nodes = [node for (node,) in nodes]
+    queries = brain_export_queries(brain)
+    if mimetype == 'application/x-ndjson':
+        stream = stream_brain(session, queries)
+        if admission:
+            # held until the whole brain is sent, or the response body is closed
+            await admission['export'].acquire()
+            stream = admission['export'].streaming(stream)
+        try:
+            response = Response(stream, mimetype=mimetype)
+        except BaseException:
+            if admission:
+                await stream.aclose()
+            raise
+        response.timeout = None
+        return response
+    return await export_brain(session, queries)
+
+
+@admitted('export')
+async def export_brain(session, queries):
+    result = {}
+    for rtype, query in queries:
+        rows = await session.execute(query)
+        result[rtype + 's'] = [data for (data,) in rows]
+    return result
+
+
+def brain_export_queries(brain):
     n1 = aliased(Node)
     n2 = aliased(Node)
-    links = await session.execute(select(Link.data).filter_by(brain_id=brain.id
-        ).join(n1, (Link.parent_id==n1.id) & (n1.private==False)
-        ).join(n2, (Link.child_id==n2.id) & (n2.private==False)))
-    links = [link for (link,) in links]
-    attachments = await session.execute(select(
-        Attachment.data).join(Node).filter_by(brain_id=brain.id, private=False))
-    attachments = [attachment for (attachment,) in attachments]
-    return dict(nodes=nodes, links=links, attachments=attachments)
+    return [
+        ('node', select(Node.data).filter_by(brain_id=brain.id, private=False)),
+        ('link', select(Link.data).filter_by(brain_id=brain.id
+            ).join(n1, (Link.parent_id==n1.id) & (n1.private==False)
+            ).join(n2, (Link.child_id==n2.id) & (n2.private==False))),
+        ('attachment', select(
+            Attachment.data).join(Node).filter_by(brain_id=brain.id, private=False)),
+    ]
+
+
+async def stream_brain(session, queries, batch_size=1000):
+    # server-side cursors: memory stays bounded by batch_size whatever the brain size
+    for rtype, query in queries:
+        rows = await session.stream(query.execution_options(yield_per=batch_size))
+        async for partition in rows.partitions():
+            yield "".join(
+                json.dumps(dict(type=rtype, data=data)) + "\n"
+                for (data,) in partition)
+
+
+@app.route("/metrics")
+async def metrics():
+    return dict(
+        prefetch=prefetcher.metrics() if prefetcher else None,
+        write_behind=cache_writer.metrics() if cache_writer else None,
+        admission=admission.metrics() if admission else None,
+        upstream=upstream.metrics())
 
 
 @app.route("/brain/<brain_slug>/search")
+@admitted('search')
 async def search(brain_slug):
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, brain_slug)
     if not brain:
         return Response("No such brain", status=404)
@@ -143,6 +274,69 @@ async def search(brain_slug):
         start=start+1, end=start+len(nodes), prev_link=prev_link, next_link=next_link)
 
 
+@app.route("/brain/<brain_slug>/path")
+@admitted('graph')
+async def path(brain_slug):
+    session = db_session()
+    brain = await get_brain(session, brain_slug)
+    if not brain:
+        return Response("No such brain", status=404)
+    source = request.args.get('from', None)
+    target = request.args.get('to', None)
+    if not source or not target:
+        return Response("Give the thoughts to connect as from= and to=", status=400)
+    try:
+        max_depth = min(int(request.args.get('max_depth', 8)), 16)
+    except ValueError:
+        return Response("max_depth should be a number", status=400)
+    result = await find_path(session, brain, source, target, max_depth)
+    if result is None:
+        return Response("No such thought", status=404)
+    if not result:
+        return Response(f"No path within {max_depth} steps", status=404)
+    return dict(result, brain=brain.id, **{'from': source, 'to': target})
+
+
+# POST /brain/<slug>/thoughts:batch
+batch_max_ids = mbconfig.getint('batch_max_ids', 2000)
+batch_max_refresh = mbconfig.getint('batch_max_refresh', 100)
+batch_refresh_concurrency = mbconfig.getint('batch_refresh_concurrency', 8)
+
+
+@app.route("/brain/<brain_slug>/thoughts:batch", methods=['POST'])
+@admitted('batch')
+async def thoughts_batch(brain_slug):
+    session = db_session()
+    brain = await get_brain(session, brain_slug)
+    if not brain:
+        return Response("No such brain", status=404)
+    body = await request.get_json(silent=True) or {}
+    ids = body.get('ids', None)
+    if not isinstance(ids, list) or not all(isinstance(id, str) for id in ids):
+        return Response('Expected {"ids": [thought ids]}', status=400)
+    if len(ids) > batch_max_ids:
+        return Response(f"At most {batch_max_ids} ids", status=413)
+    ids = list(dict.fromkeys(ids))
+    # malformed ids are missing, rather than failing the query
+    valid = [id for id in ids if UUID_RE.match(id)]
+    nodes = await get_nodes(session, brain, valid, body.get('refresh', True),
+                            batch_refresh_concurrency, batch_max_refresh)
+    public = [id for id in ids if id in nodes and not nodes[id].private]
+    neighbours = await neighbour_summaries(session, brain, public) if body.get('neighbours') else None
+    thoughts = {}
+    for id in public:
+        node = nodes[id]
+        thoughts[id] = dict(
+            node.data, notesHtml=node.get_html_notes(), notesMarkdown=node.get_md_notes(),
+            url=node.url_link())
+        if neighbours is not None:
+            thoughts[id]['neighbours'] = neighbours.get(id, {})
+    return dict(
+        brain=brain.id, thoughts=thoughts,
+        private=[id for id in ids if id in nodes and nodes[id].private],
+        missing=[id for id in ids if id not in nodes])
+
+
 @app.route("/url", methods=['POST'])
 async def url():
     form = await request.form
@@ -161,7 +355,7 @@ async def url():
     if url.startswith('https://app.thebrain.com/'):
         match = BRAIN_URL_RE.match(url)
         if match is not None:
-            session = request.scope['session']
+            session = db_session()
             brain_id, thought_id = match.group(
                 'brain_id'), match.group('thought_id')
             await add_brain(session, brain_id, slug, name, thought_id)
@@ -174,15 +368,98 @@ async def url():
     )
 
 
-async def recompose_data(node, with_attachments=False, siblings=True, gate_counts=False, **kwargs):
-    linkst = dict(parent={}, child={}, sibling={}, jump={}, tag={}, of_tag={})
+# reln_type -> the list of neighbour ids in the root of graph data
+data_relations = dict(parent='parents', child='children', sibling='siblings', jump='jumps')
+
+
+def links_from_data(data, limit, after=None, parents=True, children=True, siblings=True, jumps=True,
+                    tags=True, private=False, **kwargs):
+    """A page of neighbour names by relation from graph data, after the cursors in `after`,
+    as (linkst, counts, cursors) like neighbour_page."""
+    thoughts = {t['id']: t for t in data.get('thoughts', ())}
+    root = data['root']
+    after = after or {}
+    shown = dict(parent=parents, child=children, sibling=siblings, jump=jumps)
+    found = {}
+    for (ltype, key) in data_relations.items():
+        if shown[ltype] and key in root:
+            found[ltype] = [thoughts[id] for id in root[key] if id in thoughts
+                            and (private or not thoughts[id].get('ACType', 0))]
+    if tags and 'tags' in data:
+        found['tag'] = [t for t in data['tags'] if private or not t.get('ACType', 0)]
+    linkst, counts, cursors = {}, {}, {}
+    for (ltype, neighbours) in found.items():
+        keys = sorted({(t['name'], t['id']) for t in neighbours})
+        counts[ltype] = len(keys)
+        if ltype in after:
+            keys = [key for key in keys if key > after[ltype]]
+        if len(keys) > limit:
+            keys = keys[:limit]
+            cursors[ltype] = keys[-1]
+        linkst[ltype] = {id: name for (name, id) in keys}
+    return linkst, counts, cursors
+
+
+def page_data(data, limit, after=None, **kwargs):
+    """Graph data cut to a page of each relation, as links_from_data takes them,
+    with the thoughts, links and attachments of that page, and `pages`."""
+    linkst, counts, cursors = links_from_data(data, limit, after, **kwargs)
+    root = data['root']
+    kept = {root['id']}.union(*linkst.values())
+    tags = linkst.get('tag', {})
+    if 'attachments' in data:
+        data = dict(data, attachments=[
+            a for a in data['attachments'] if a.get('sourceId', root['id']) in kept])
+    return dict(
+        data,
+        root=dict(root, **{key: list(linkst.get(ltype, {})) for (ltype, key) in data_relations.items()
+                           if key in root}),
+        thoughts=[t for t in data.get('thoughts', ()) if t['id'] in kept],
+        links=[l for l in data.get('links', ())
+               if l['thoughtIdA'] in kept and l['thoughtIdB'] in kept],
+        tags=[t for t in data.get('tags', ()) if t['id'] in tags],
+        pages=neighbour_pages(counts, cursors))
+
+
+def encode_cursor(key):
+    "The (name, id) of the last neighbour shown, as an after_<reln_type> argument."
+    return urlsafe_b64encode(json.dumps(list(key)).encode()).decode('ascii').rstrip('=')
+
+
+def decode_cursor(value):
+    try:
+        name, id = json.loads(urlsafe_b64decode(value + '=' * (-len(value) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError(f"Invalid cursor: {value}")
+    if not isinstance(name, str) or not isinstance(id, str):
+        raise ValueError(f"Invalid cursor: {value}")
+    return name, id
+
+
+def neighbour_pages(counts, cursors):
+    "{reln_type: dict(total, after, next)}, where `next` is the URL of the next page, if any."
+    pages = {}
+    for (ltype, total) in counts.items():
+        page = dict(total=total, after=None, next=None)
+        if ltype in cursors:
+            args = request.args.to_dict()
+            args[f'after_{ltype}'] = page['after'] = encode_cursor(cursors[ltype])
+            page['next'] = f"{request.path}?{urlencode(args)}"
+        pages[ltype] = page
+    return pages
+
+
+async def recompose_data(node, limit, after=None, with_attachments=False, siblings=True,
+                         gate_counts=False, **kwargs):
+    linkst = dict(parent={}, child={}, sibling={}, jump={}, tag={}, of_tag={}, same_type={})
     thoughts = [node.data]
     links = []
     tags = []
-    session = request.scope['session']
-    for ltype, node_, link in await node.get_neighbour_data(
-            session, True, True,
-            with_attachments=with_attachments, siblings=siblings):
+    session = db_session()
+    rows, counts, cursors = await neighbour_page(
+        session, node, limit, after, full=True, with_links=True,
+        with_attachments=with_attachments, siblings=siblings)
+    for ltype, node_, link in rows:
         linkst[ltype][node_.id] = node_.name
         data = dict(node_.data)
         if with_attachments:
@@ -214,13 +491,13 @@ async def recompose_data(node, with_attachments=False, siblings=True, gate_count
     data = dict(
         root=root, thoughts=thoughts, links=links,
         brainId=node.brain.id, isUserAuthenticated=False, errors=[], stamp=0,
-        status=1, tags=[tag.data for tag in tags])
+        status=1, tags=[tag.data for tag in tags], pages=neighbour_pages(counts, cursors))
     if node.html_attachments:
         data['notesHtml'] = node.html_attachments[0].text_content
     if node.md_attachments:
         data['notesMarkdown'] = node.md_attachments[0].text_content
     if gate_counts:
-        data['gateCounts'] = await node.gate_counts(session)
+        data['gateCounts'] = await node_gate_counts(session, node)
     return linkst, data
 
 
@@ -232,10 +509,43 @@ show_defaults = {'parents', 'children', 'siblings', 'jumps', 'tags', 'of_tags'}
 show_defaults = {arg: arg in show_defaults for arg in show_args}
 show_data_defaults = {'text_links', 'text_backlinks', 'with_attachments'}
 show_data_defaults = {arg: arg in show_data_defaults for arg in show_args}
+neighbour_types = ('parent', 'child', 'sibling', 'same_type', 'jump', 'tag', 'of_tag',
+                   'text_link', 'text_backlink')
+# neighbours of each relation per page; hubs have thousands
+neighbour_page_size = mbconfig.getint('neighbour_page_size', 100)
+neighbour_max_page_size = mbconfig.getint('neighbour_max_page_size', 1000)
+
+
+def cached_response(entry):
+    "Serve a cached response, or a 304 if the client has it already."
+    headers = dict(entry.headers, ETag=f'"{entry.etag}"')
+    if entry.last_modified:
+        headers['Last-Modified'] = http_date(entry.last_modified)
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains(entry.etag)
+    else:
+        not_modified = bool(request.if_modified_since and entry.last_modified
+            and not modified_since(entry.last_modified, request.if_modified_since))
+    if not_modified:
+        return Response(status=304, headers=headers)
+    return Response(entry.body, mimetype=entry.mimetype, headers=headers)
+
+
+def cache_response(key, node, names, body, mimetype, headers=None, shared=True, since=None):
+    """Store and send a rendered response. `since` is the response cache generation
+    read before the data: if its nodes were invalidated since, it is only sent."""
+    headers = dict(headers or {}, **surrogate_headers(key[0], names.keys(), shared, node.id))
+    etag = make_etag(body, mimetype, sorted(headers.items()))
+    entry = CachedResponse(body, mimetype, etag, node.last_modified, names.keys(), headers)
+    if response_cache:
+        response_cache.put(key, entry, since)
+    return cached_response(entry)
+
 
 @app.route("/brain/<brain_slug>/thought/<thought_id>/")
+@admitted('thoughts')
 async def get_thought_route(brain_slug, thought_id):
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, brain_slug)
     if not brain:
         return Response("No such brain", status=404)
@@ -261,7 +571,15 @@ async def get_thought_route(brain_slug, thought_id):
     non_default = {arg: val for (arg, val) in show_vals.items() if val != my_show_defaults[arg]}
     show_query_string = "?show=" + ",".join([('' if val else '-')+arg for (arg, val) in non_default.items()])
     show_json = show_vals.pop('json')
-    show_vals.pop('gate_counts')
+    show_gate_counts = show_vals.pop('gate_counts')
+    try:
+        page_size = min(int(request.args.get('limit', neighbour_page_size)), neighbour_max_page_size)
+        after = {ltype: decode_cursor(request.args[f'after_{ltype}'])
+                 for ltype in neighbour_types if f'after_{ltype}' in request.args}
+    except ValueError:
+        return Response("limit should be a number, and after_* the cursors given by a page", status=400)
+    if page_size < 1:
+        return Response("limit should be positive", status=400)
 
     force = request.args.get('reload', False)
     # add cache_staleness and siblings to query string
@@ -274,13 +592,33 @@ async def get_thought_route(brain_slug, thought_id):
         force = True
     else:
         cache_staleness = timedelta(days=cache_staleness) if cache_staleness > 0 else None
-    node, data = await get_node(session, brain, thought_id, force=force, cache_staleness=cache_staleness)
+    if prefetcher:
+        prefetcher.record_view(brain.id, thought_id)
+    if scheduler:
+        scheduler.record_access(brain.id, thought_id)
+    # anything rendered from what we read next is only stored if still current
+    since = response_cache.generation if response_cache else None
+    # the CSV export reads neighbours back from the database
+    node, data = await get_node(session, brain, thought_id, force=force, cache_staleness=cache_staleness,
+                                write_behind=mimetype != 'text/csv')
     if not node:
         return Response("No such thought", status=404)
+    mark_if_stale(node)
+    fresh = data is not None
 
     if node.private:
         # TODO: Give the brain link
         return Response("Private thought", status=403)
+    if prefetcher:
+        prefetcher.after_view(brain.id, node, data)
+    cache_key = (brain.id, node.id, tuple(sorted(show_vals.items())) + (
+        ('json', show_json), ('gate_counts', show_gate_counts),
+        ('limit', page_size), ('after', tuple(sorted(after.items())))), mimetype)
+    if response_cache and not fresh:
+        # fresh upstream data is newer than what we rendered, even before it is stored
+        entry = response_cache.get(cache_key)
+        if entry:
+            return cached_response(entry)
 
     if mimetype == 'application/json':
         if data and show_vals['with_attachments']:
@@ -290,16 +628,28 @@ async def get_thought_route(brain_slug, thought_id):
             for node in data['thoughts']:
                 if node['id'] in links_by_id:
                     node['attachments'] = [l.data for l in links_by_id[node['id']]]
-        return data or (await recompose_data(node, **show_vals))[1]
+        if data:
+            # fresh upstream data has every neighbour of a hub
+            data = page_data(data, page_size, after, **show_vals)
+        else:
+            data = (await recompose_data(
+                node, page_size, after, gate_counts=show_gate_counts, **show_vals))[1]
+        if show_gate_counts and 'gateCounts' not in data:
+            data = dict(data, gateCounts=await node_gate_counts(session, node))
+        names = {node.id: node.name}
+        names.update({t['id']: t.get('name') for t in [*data.get('thoughts', ()), *data.get('tags', ())]})
+        return cache_response(cache_key, node, names, json.dumps(data), mimetype, since=since)
     elif mimetype == 'text/csv':
-        neighbours = list(await node.get_neighbour_data(session, True, True, **show_vals))
+        neighbours, counts, cursors = await neighbour_page(
+            session, node, page_size, after, full=True, with_links=True, **show_vals)
         reread = False
         for rel, node2, link in neighbours:
             if not node2.read_as_focus:
                 node2 = await get_node(session, brain, node2.id, force=True)
                 reread = True
         if reread:
-            neighbours = await node.get_neighbour_data(session, True, True, **show_vals)
+            neighbours, counts, cursors = await neighbour_page(
+                session, node, page_size, after, full=True, with_links=True, **show_vals)
         si = StringIO()
         cw = csv.writer(si)
         cw.writerow(["Name", "Node_UUID", "Node_Type", "URL", "Notes", "Link_Type", "Link_UUID"])
@@ -308,13 +658,19 @@ async def get_thought_route(brain_slug, thought_id):
             cw.writerow([node2.name, node2.id, node2.type_name, node2.url_link(),
                 node2.get_notes_as_md(), rel, link.id if link else ""])
 
-        output = make_response(si.getvalue())
-        output.headers["Content-Disposition"] = "attachment; filename=export.csv"
-        output.headers["Content-type"] = "text/csv"
-        return output
+        names = {node.id: node.name}
+        names.update({node2.id: node2.name for (rel, node2, link) in neighbours})
+        headers = {"Content-Disposition": "attachment; filename=export.csv"}
+        next_pages = [f'<{page["next"]}>; rel="next"; title="{ltype}"'
+                      for (ltype, page) in neighbour_pages(counts, cursors).items() if page['next']]
+        if next_pages:
+            headers['Link'] = ', '.join(next_pages)
+        # with the notes of neighbours, read for this request: not for shared caches
+        return cache_response(cache_key, node, names, si.getvalue(), mimetype, headers, shared=False, since=since)
 
     if show_json and not data:
-        linkst, data = await recompose_data(node, **show_vals)
+        linkst, data = await recompose_data(node, page_size, after, **show_vals)
+        pages = data['pages']
     else:
         if not data:
             # TODO: Store in node
@@ -322,8 +678,20 @@ async def get_thought_route(brain_slug, thought_id):
             data = dict(root=root, notesHtml="", notesMarkdown="", tags=[])
         linkst = dict(parent={}, child={}, sibling={},
                     jump={}, tag={}, of_tag={}, same_type={})
-        for (ltype, id, name) in await node.get_neighbour_data(session, **show_vals):
+        rows, counts, cursors = await neighbour_page(session, node, page_size, after, **show_vals)
+        for (ltype, id, name) in rows:
             linkst[ltype][id] = name
+        if fresh:
+            # the database may not have these yet
+            fresh_links, fresh_counts, fresh_cursors = links_from_data(
+                data, page_size, after, **show_vals)
+            for ltype in fresh_links:
+                linkst[ltype] = fresh_links[ltype]
+                counts[ltype] = fresh_counts[ltype]
+                cursors.pop(ltype, None)
+                if ltype in fresh_cursors:
+                    cursors[ltype] = fresh_cursors[ltype]
+        pages = neighbour_pages(counts, cursors)
 
     # create a lookup table of names by thought_id
     names = {node.id: node.name}
@@ -339,7 +707,7 @@ async def get_thought_route(brain_slug, thought_id):
         notes_html = resolve_html_links(notes_html)
 
     # render page
-    return await render_template(
+    return cache_response(cache_key, node, names, await render_template(
         'index.html',
         json=json.dumps(data, indent=2),
         show_vals=show_vals,
@@ -355,15 +723,40 @@ async def get_thought_route(brain_slug, thought_id):
         jumps=linkst['jump'],
         of_tag=linkst['of_tag'],
         same_type=linkst['same_type'],
+        pages=pages,
         names=names,
         attachments=node.attachments,
         notes_html=notes_html,
-    )
+    ), 'text/html', since=since)
+
+
+@app.route("/brain/<brain_slug>/thought/<thought_id>/subgraph")
+@admitted('graph')
+async def get_subgraph(brain_slug, thought_id):
+    session = db_session()
+    brain = await get_brain(session, brain_slug)
+    if not brain:
+        return Response("No such brain", status=404)
+    try:
+        depth = min(int(request.args.get('depth', 2)), 4)
+        limit = min(int(request.args.get('limit', 500)), 5000)
+        fanout = min(int(request.args.get('fanout', 50)), 500)
+    except ValueError:
+        return Response("depth, limit and fanout should be numbers", status=400)
+    relations = request.args.get('relations', None)
+    relations = relations.split(',') if relations else RELATIONS
+    if not relations or not set(relations) <= set(RELATIONS):
+        return Response(f"relations should be among {','.join(RELATIONS)}", status=400)
+    result = await subgraph(session, brain, thought_id, depth, limit, fanout, relations)
+    if result is None:
+        return Response("No such thought", status=404)
+    return dict(result, brain=brain.id, depth=depth)
 
 
 @app.route("/brain/<brain_slug>/thought/<thought_id>/.data/md-images/<location>")
+@admitted('images')
 async def get_image_content(brain_slug, thought_id, location):
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, brain_slug)
     if not brain:
         return Response("No such brain", status=404)
@@ -389,7 +782,8 @@ async def get_image_content(brain_slug, thought_id, location):
         if not atts:
             return Response("No such image", status=404)
         att = atts[0]
-    await att.populate_content(httpx_client)
+    if not (admission and admission.degraded):
+        await att.populate_content(upstream)
     content = att.text_content or att.content
     if not content:
         # maybe a permission issue? redirect to brain
@@ -400,9 +794,10 @@ async def get_image_content(brain_slug, thought_id, location):
 
 @app.route("/brain/<brain_slug>/thought/<thought_id>/notes")
 async def get_notes(brain_slug, thought_id):
-    session = request.scope['session']
+    session = db_session()
     brain = await get_brain(session, brain_slug)
     if not brain:
         return Response("No such brain", status=404)
     node, data = await get_node(session, brain, thought_id, force=False)
+    mark_if_stale(node)
     return Response(node.get_notes_as_html())
@@ -0,0 +1,323 @@
+from collections import defaultdict
+from datetime import timezone
+from functools import lru_cache
+import enum
+
+import simplejson as json
+from sqlalchemy import (
+    Boolean, DateTime, table, column, text, union_all, update, literal, literal_column, bindparam)
+from sqlalchemy.dialects.postgresql import insert, JSONB
+from sqlalchemy.future import select
+from sqlalchemy.sql import func, case
+
+from .models import Node, Link, Attachment, LinkRelation
+
+BATCH_SIZE = 5000
+# rows per INSERT ... VALUES, under the 32767 bind parameters of a postgres statement
+VALUES_CHUNK = 1000
+# true in RETURNING for rows that an upsert inserted, rather than updated
+INSERTED = literal_column('xmax = 0').label('inserted')
+# node columns maintained locally, which TheBrain data never overwrites
+NODE_LOCAL_COLUMNS = {'id', 'access_count', 'last_access', 'upstream_etag', 'upstream_last_modified',
+                      'child_count', 'parent_count', 'jump_count'}
+
+
+def naive_utc(value):
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def _normalize(value, col_type):
+    if isinstance(value, enum.Enum):
+        # postgres enum labels are the member names
+        return value.name
+    if value is None:
+        return None
+    if isinstance(col_type, Boolean):
+        return bool(value)
+    if isinstance(col_type, JSONB):
+        return json.dumps(value)
+    if isinstance(col_type, DateTime):
+        return naive_utc(value)
+    return value
+
+
+@lru_cache()
+def record_columns(tbl):
+    """The columns of a COPY record, in table order. Local node columns are
+    left out, so that new rows get their server defaults."""
+    return tuple(col for col in tbl.columns
+                 if tbl is not Node.__table__ or col.name == 'id' or col.name not in NODE_LOCAL_COLUMNS)
+
+
+def as_record(obj):
+    "The column values of a (transient) ORM object, as in record_columns, ready for COPY."
+    return tuple(
+        _normalize(getattr(obj, col.key), col.type)
+        for col in record_columns(obj.__table__))
+
+
+def as_values(obj, exclude=()):
+    "The column values of a (transient) ORM object, for insert().values()."
+    values = {}
+    for col in obj.__table__.columns:
+        if col.name in exclude:
+            continue
+        value = getattr(obj, col.key)
+        if value is not None and isinstance(col.type, Boolean):
+            value = bool(value)
+        elif isinstance(col.type, DateTime):
+            value = naive_utc(value)
+        values[col.name] = value
+    return values
+
+
+def node_upsert(stmt, force=False):
+    "Merge rule for nodes: only overwrite with newer data, or when first read as focus."
+    existing = Node.__table__.c
+    excluded = stmt.excluded
+    set_ = {col.name: excluded[col.name] for col in Node.__table__.columns
+            if col.name not in NODE_LOCAL_COLUMNS}
+    set_.update(
+        data=func.coalesce(existing.data, text("'{}'::jsonb")).op('||')(excluded.data),
+        # tags are only known for the focus (an empty list when all were removed)
+        tags=case((excluded.tags.is_(None), existing.tags), else_=excluded.tags),
+        read_as_focus=func.coalesce(existing.read_as_focus, False) | excluded.read_as_focus,
+        text_links=case(
+            (excluded.read_as_focus, excluded.text_links), else_=existing.text_links),
+    )
+    where = None if force else (
+        (existing.last_modified < excluded.last_modified) |
+        (excluded.read_as_focus & ~func.coalesce(existing.read_as_focus, False)))
+    return stmt.on_conflict_do_update(index_elements=['id'], set_=set_, where=where)
+
+
+def link_upsert(stmt, force=False):
+    existing = Link.__table__.c
+    excluded = stmt.excluded
+    set_ = {col.name: excluded[col.name] for col in Link.__table__.columns if col.name != 'id'}
+    where = None if force else (existing.last_modified < excluded.last_modified)
+    return stmt.on_conflict_do_update(index_elements=['id'], set_=set_, where=where)
+
+
+def attachment_upsert(stmt, force=False):
+    existing = Attachment.__table__.c
+    excluded = stmt.excluded
+    set_ = {col.name: excluded[col.name] for col in Attachment.__table__.columns if col.name != 'id'}
+    # keep the stored content unless we were given some
+    has_content = excluded.content.isnot(None) | excluded.text_content.isnot(None)
+    for name in ('content', 'text_content', 'inferred_locale'):
+        set_[name] = case((has_content, excluded[name]), else_=existing[name])
+    where = None if force else (existing.last_modified < excluded.last_modified)
+    return stmt.on_conflict_do_update(index_elements=['id'], set_=set_, where=where)
+
+
+UPSERTS = {
+    Node.__table__: node_upsert,
+    Link.__table__: link_upsert,
+    Attachment.__table__: attachment_upsert,
+}
+
+
+async def upsert(session, tbl, rows, force=False, returning=('id',)):
+    """Merge rows (dicts from as_values) into the table with its UPSERTS rule,
+    without writing unchanged rows, in id order so that concurrent upserts lock
+    rows in the same order. Returns the `returning` columns (names or
+    expressions, like INSERTED) of written rows."""
+    written = []
+    rows = sorted(rows, key=lambda row: row['id'])
+    returning = [tbl.c[name] if isinstance(name, str) else name for name in returning]
+    for i in range(0, len(rows), VALUES_CHUNK):
+        stmt = insert(tbl).values(rows[i:i + VALUES_CHUNK])
+        stmt = UPSERTS[tbl](stmt, force).returning(*returning)
+        written.extend(await session.execute(stmt))
+    return written
+
+
+def link_count_deltas(deltas, parent_id, child_id, relation, sign=1):
+    "Add what a link counts for to {node id: [children, parents, jumps]}."
+    if relation == LinkRelation.Jump:
+        deltas[parent_id][2] += sign
+    else:
+        deltas[parent_id][0] += sign
+        deltas[child_id][1] += sign
+
+
+async def lock_nodes(session, ids):
+    """Lock these nodes in id order, so that concurrent writers, which lock
+    them in the same order, do not deadlock on hubs."""
+    ids = sorted(ids)
+    node = Node.__table__
+    for i in range(0, len(ids), BATCH_SIZE):
+        await session.execute(select(node.c.id).where(node.c.id.in_(ids[i:i + BATCH_SIZE])
+                                                      ).order_by(node.c.id).with_for_update())
+
+
+async def add_link_counts(session, deltas):
+    """Add {node id: [children, parents, jumps]} to the stored counts,
+    locking the nodes first (a no-op if the caller already holds them)."""
+    ids = sorted(id for (id, delta) in deltas.items() if any(delta))
+    if not ids:
+        return
+    node = Node.__table__
+    await lock_nodes(session, ids)
+    await session.execute(update(node).where(node.c.id == bindparam('node_id')).values(
+        child_count=func.coalesce(node.c.child_count, 0) + bindparam('children'),
+        parent_count=func.coalesce(node.c.parent_count, 0) + bindparam('parents'),
+        jump_count=func.coalesce(node.c.jump_count, 0) + bindparam('jumps')),
+        [dict(node_id=id, children=deltas[id][0], parents=deltas[id][1], jumps=deltas[id][2])
+         for id in ids])
+
+
+async def count_written_links(session, brain_id, previous, written):
+    """Update the stored counts for links just upserted, from what they were before:
+    `previous` is {id: (parent_id, child_id, relation)} of the links that existed,
+    read FOR UPDATE, and `written` the (id, parent_id, child_id, relation, inserted)
+    upsert returned. Only inserted or re-typed links change counts."""
+    deltas = defaultdict(lambda: [0, 0, 0])
+    recount = set()
+    for (id, parent_id, child_id, relation, inserted) in written:
+        if id in previous:
+            if previous[id] == (parent_id, child_id, relation):
+                continue
+            link_count_deltas(deltas, *previous[id], sign=-1)
+        elif not inserted:
+            # inserted by a concurrent transaction since we looked: count from scratch
+            recount.update((parent_id, child_id))
+            continue
+        link_count_deltas(deltas, parent_id, child_id, relation)
+    await add_link_counts(session, deltas)
+    if recount:
+        await update_link_counts(session, brain_id, recount)
+
+
+def link_counts(brain_id, node_ids=None):
+    "(id, children, parents, jumps) of the nodes of a brain, or of these nodes, from their links."
+    jump = Link.relation == LinkRelation.Jump
+    outgoing = select(
+        Link.parent_id.label('id'), case((jump, 0), else_=1).label('children'),
+        literal(0).label('parents'), case((jump, 1), else_=0).label('jumps')
+    ).filter(Link.brain_id == brain_id)
+    incoming = select(Link.child_id, literal(0), literal(1), literal(0)).filter(
+        Link.brain_id == brain_id, ~jump)
+    nodes = select(Node.id).filter(Node.brain_id == brain_id)
+    if node_ids is not None:
+        outgoing = outgoing.filter(Link.parent_id.in_(node_ids))
+        incoming = incoming.filter(Link.child_id.in_(node_ids))
+        nodes = nodes.filter(Node.id.in_(node_ids))
+    ends = union_all(outgoing, incoming).subquery()
+    counts = select(
+        ends.c.id, func.sum(ends.c.children).label('children'),
+        func.sum(ends.c.parents).label('parents'), func.sum(ends.c.jumps).label('jumps')
+    ).group_by(ends.c.id).subquery()
+    nodes = nodes.subquery()
+    return select(
+        nodes.c.id,
+        func.coalesce(counts.c.children, 0).label('children'),
+        func.coalesce(counts.c.parents, 0).label('parents'),
+        func.coalesce(counts.c.jumps, 0).label('jumps'),
+    ).outerjoin(counts, counts.c.id == nodes.c.id)
+
+
+async def update_link_counts(session, brain_id, node_ids=None):
+    """Set the stored child, parent and jump counts of the nodes of a brain (or of
+    these nodes) from their links, writing only the rows that change.
+    Returns the ids of the nodes updated."""
+    node = Node.__table__
+    if node_ids is not None:
+        node_ids = sorted(node_ids)
+        chunks = [node_ids[i:i + BATCH_SIZE] for i in range(0, len(node_ids), BATCH_SIZE)]
+    else:
+        chunks = [None]
+    updated = []
+    for ids in chunks:
+        counts = link_counts(brain_id, ids).subquery()
+        result = await session.execute(update(node).where(
+            (node.c.id == counts.c.id) & (
+                node.c.child_count.is_distinct_from(counts.c.children) |
+                node.c.parent_count.is_distinct_from(counts.c.parents) |
+                node.c.jump_count.is_distinct_from(counts.c.jumps))
+        ).values(child_count=counts.c.children, parent_count=counts.c.parents,
+                 jump_count=counts.c.jumps
+        ).returning(node.c.id).execution_options(synchronize_session=False))
+        updated.extend(id for (id,) in result)
+    return updated
+
+
+class BulkLoader:
+    """Stage rows through COPY into temporary tables, and merge them
+    into the real tables in one set-based statement per batch.
+    With `track_link_ends`, the nodes at either end of merged links, before
+    and after, are collected in `link_ends`, for update_link_counts."""
+
+    def __init__(self, session, batch_size=BATCH_SIZE, force=False, track_link_ends=False):
+        self.session = session
+        self.batch_size = batch_size
+        self.force = force
+        self.track_link_ends = track_link_ends
+        self.link_ends = set()
+        self.pending = {tbl: {} for tbl in UPSERTS}
+        self.staged = set()
+        self.counts = {tbl.name: 0 for tbl in UPSERTS}
+
+    async def driver_connection(self):
+        conn = await self.session.connection()
+        raw = await conn.get_raw_connection()
+        return raw.driver_connection
+
+    async def add(self, obj):
+        await self.add_record(obj.__table__, obj.id, as_record(obj))
+
+    async def add_record(self, tbl, id, record):
+        rows = self.pending[tbl]
+        previous = rows.get(id, None)
+        # a statement cannot update the same row twice: keep the newest version
+        if previous is None or not is_older(tbl, record, previous):
+            rows[id] = record
+        if len(rows) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self, tbl=None):
+        if tbl is None:
+            # parents before children, for foreign keys
+            for tbl in UPSERTS:
+                await self.flush(tbl)
+            return
+        rows = self.pending[tbl]
+        if not rows:
+            return
+        staging = f"bulk_{tbl.name}"
+        if tbl not in self.staged:
+            await self.session.execute(text(
+                f"CREATE TEMP TABLE IF NOT EXISTS {staging} (LIKE {tbl.name} INCLUDING DEFAULTS)"))
+            self.staged.add(tbl)
+        names = [col.name for col in record_columns(tbl)]
+        apg = await self.driver_connection()
+        await apg.copy_records_to_table(staging, records=list(rows.values()), columns=names)
+        source = table(staging, *[column(name) for name in names])
+        stmt = UPSERTS[tbl](insert(tbl).from_select(names, select(*source.c)), self.force)
+        if self.track_link_ends and tbl is Link.__table__:
+            # the ends a link is moved away from lose it
+            for (parent_id, child_id) in await self.session.execute(
+                    select(tbl.c.parent_id, tbl.c.child_id).join(source, source.c.id == tbl.c.id)):
+                self.link_ends.update((parent_id, child_id))
+            stmt = stmt.returning(tbl.c.parent_id, tbl.c.child_id)
+            for (parent_id, child_id) in await self.session.execute(stmt):
+                self.link_ends.update((parent_id, child_id))
+        else:
+            await self.session.execute(stmt)
+        await self.session.execute(text(f"TRUNCATE {staging}"))
+        self.counts[tbl.name] += len(rows)
+        rows.clear()
+
+
+def record_last_modified(tbl, record):
+    return record[[col.name for col in record_columns(tbl)].index('last_modified')]
+
+
+def is_older(tbl, record, other):
+    record, other = record_last_modified(tbl, record), record_last_modified(tbl, other)
+    if record is None or other is None:
+        return False
+    return record < other
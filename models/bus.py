@@ -0,0 +1,119 @@
+import asyncio
+from logging import exception, warning
+from uuid import uuid4
+
+import asyncpg
+import simplejson as json
+from sqlalchemy.future import select
+from sqlalchemy.sql import func
+
+from . import mbconfig
+from .cache import invalidate, clear_caches, on_publish, on_publish_in_transaction
+from .utils import spawn
+from .routing import written
+
+CHANNEL = 'memebrane_invalidate'
+# NOTIFY payloads must stay under 8000 bytes
+MAX_IDS = 150
+WORKER_ID = uuid4().hex
+
+
+def payloads(brain_id, nodes=(), links=(), attachments=(), brain=False, worker=WORKER_ID):
+    ids = [('n', id) for id in nodes] + [('l', id) for id in links] + [('a', id) for id in attachments]
+    if len(ids) > 10 * MAX_IDS:
+        # cheaper to drop the whole brain than to send that many messages
+        return [json.dumps(dict(w=worker, b=brain_id, brain=True))]
+    messages = []
+    for i in range(0, max(len(ids), 1), MAX_IDS):
+        message = dict(w=worker, b=brain_id, n=[], l=[], a=[], brain=brain)
+        for kind, id in ids[i:i + MAX_IDS]:
+            message[kind].append(id)
+        messages.append(json.dumps(message))
+    return messages
+
+
+async def notify_in_transaction(session, brain_id, **kwargs):
+    "Queue invalidations that are sent when the session's transaction commits."
+    for payload in payloads(brain_id, **kwargs):
+        await session.execute(select(func.pg_notify(CHANNEL, payload)))
+
+
+def dsn():
+    url = mbconfig['dburl']
+    return url.replace('postgresql+asyncpg:', 'postgresql:')
+
+
+class InvalidationBus:
+    """Shares cache invalidations between workers with Postgres LISTEN/NOTIFY.
+    Local writes are published; notifications from other workers are applied
+    to the local caches, which are cleared whenever the connection is lost."""
+
+    def __init__(self, retry_delay=5.0):
+        self.retry_delay = retry_delay
+        self.conn = None
+        self.lock = asyncio.Lock()
+        self.task = None
+        self.listened = False
+
+    def on_notify(self, conn, pid, channel, payload):
+        try:
+            message = json.loads(payload)
+            if message['w'] == WORKER_ID:
+                return
+            # the invalidation also keeps reads of the brain off lagging replicas
+            invalidate(message['b'], message.get('n', ()), message.get('l', ()),
+                       message.get('a', ()), message.get('brain', False), publish=False)
+        except Exception:
+            exception(f"Bad invalidation message: {payload}")
+
+    async def publish_in_transaction(self, session, brain_id, nodes, links, attachments, brain=False):
+        await notify_in_transaction(
+            session, brain_id, nodes=nodes, links=links, attachments=attachments, brain=brain)
+
+    def publish(self, brain_id, nodes, links, attachments, brain=False):
+        # without a transaction to send it with: lost if not connected
+        if self.conn is not None:
+            spawn(self.send(payloads(brain_id, nodes, links, attachments, brain)))
+
+    async def send(self, messages):
+        try:
+            async with self.lock:
+                for payload in messages:
+                    await self.conn.execute("SELECT pg_notify($1, $2)", CHANNEL, payload)
+        except Exception:
+            exception("Could not publish invalidation")
+
+    async def run(self):
+        while True:
+            closed = asyncio.Event()
+            try:
+                self.conn = await asyncpg.connect(dsn())
+                self.conn.add_termination_listener(lambda conn: closed.set())
+                await self.conn.add_listener(CHANNEL, self.on_notify)
+                if self.listened:
+                    # anything may have changed while we were not listening
+                    written()
+                    clear_caches()
+                self.listened = True
+                await closed.wait()
+                warning("Lost the invalidation connection")
+            except (OSError, asyncpg.PostgresError):
+                exception("Could not listen for invalidations")
+            self.conn = None
+            await asyncio.sleep(self.retry_delay)
+
+    def start(self):
+        on_publish(self.publish)
+        on_publish_in_transaction(self.publish_in_transaction)
+        self.task = spawn(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        if self.conn is not None:
+            await self.conn.close()
+            self.conn = None
+
+
+bus = InvalidationBus() if mbconfig.getboolean('invalidation_bus', True) else None
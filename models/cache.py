@@ -0,0 +1,190 @@
+from collections import OrderedDict
+from datetime import timezone
+from email.utils import format_datetime
+from hashlib import sha1
+
+from . import mbconfig
+
+# callables (brain_id, node_ids, link_ids, attachment_ids, brain), called when cached data changes;
+# brain is true when the brain row itself changed
+INVALIDATION_LISTENERS = []
+# callables that drop everything a cache holds
+CLEAR_LISTENERS = []
+# callables with the same signature, that tell other processes
+INVALIDATION_PUBLISHERS = []
+# coroutine functions (session, brain_id, node_ids, link_ids, attachment_ids, brain),
+# that tell other processes when the session's transaction commits
+TRANSACTION_PUBLISHERS = []
+
+
+def on_invalidate(listener):
+    INVALIDATION_LISTENERS.append(listener)
+    return listener
+
+
+def on_clear(listener):
+    CLEAR_LISTENERS.append(listener)
+    return listener
+
+
+def invalidate(brain_id, nodes=(), links=(), attachments=(), brain=False, publish=True):
+    "Tell in-process caches, and unless publish is false other workers, that these rows were written."
+    nodes, links, attachments = set(nodes), set(links), set(attachments)
+    for listener in INVALIDATION_LISTENERS:
+        listener(brain_id, nodes, links, attachments, brain)
+    if publish:
+        for publisher in INVALIDATION_PUBLISHERS:
+            publisher(brain_id, nodes, links, attachments, brain)
+
+
+def on_publish(publisher):
+    INVALIDATION_PUBLISHERS.append(publisher)
+    return publisher
+
+
+def on_publish_in_transaction(publisher):
+    TRANSACTION_PUBLISHERS.append(publisher)
+    return publisher
+
+
+async def publish_in_transaction(session, brain_id, nodes=(), links=(), attachments=(), brain=False):
+    """Tell other workers that these rows were written, atomically with the session's commit.
+    Writers then invalidate in-process caches after the commit, with publish false."""
+    nodes, links, attachments = set(nodes), set(links), set(attachments)
+    for publisher in TRANSACTION_PUBLISHERS:
+        await publisher(session, brain_id, nodes, links, attachments, brain)
+
+
+def clear_caches():
+    for listener in CLEAR_LISTENERS:
+        listener()
+
+
+def make_etag(body, *parts):
+    "A strong validator: a hash of the body, and of whatever else is sent with it."
+    digest = sha1(body.encode('utf-8') if isinstance(body, str) else body)
+    digest.update(repr(parts).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def as_utc(dt):
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc)
+
+
+def http_date(dt):
+    return format_datetime(as_utc(dt), usegmt=True)
+
+
+def modified_since(last_modified, since):
+    "Whether last_modified is later than an If-Modified-Since date, at the second precision of HTTP dates."
+    return as_utc(last_modified).replace(microsecond=0) > as_utc(since)
+
+
+class CachedResponse:
+    def __init__(self, body, mimetype, etag, last_modified=None, nodes=(), headers=None):
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = etag
+        self.last_modified = last_modified
+        # the node ids this response shows
+        self.nodes = frozenset(nodes)
+        self.headers = headers or {}
+
+    @property
+    def size(self):
+        return len(self.body) + 64 * len(self.nodes)
+
+
+class ResponseCache:
+    """Rendered responses, evicted least recently used first beyond max_bytes.
+    A response is only stored if none of its nodes were invalidated since the
+    `generation` read before reading them."""
+
+    def __init__(self, max_bytes, tracked=10000):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        # (brain_id, node_id) -> keys of the entries showing that node
+        self.by_node = {}
+        self.size = 0
+        # counts invalidations
+        self.generation = 0
+        # (brain_id, node_id, or None for the whole brain) -> generation when last
+        # invalidated, oldest first, for the `tracked` latest
+        self.invalidated = OrderedDict()
+        self.tracked = tracked
+        # generation of the latest invalidation no longer tracked
+        self.forgotten = 0
+
+    def changed_since(self, brain_id, nodes, generation):
+        if self.forgotten > generation:
+            return True
+        return any(self.invalidated.get(key, 0) > generation
+                   for key in [(brain_id, None), *((brain_id, node_id) for node_id in nodes)])
+
+    def get(self, key):
+        entry = self.entries.get(key, None)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key, entry, since=None):
+        if entry.size > self.max_bytes:
+            return
+        if since is not None and self.changed_since(key[0], entry.nodes, since):
+            # rendered from rows that may be outdated already
+            return
+        self.evict(key)
+        self.entries[key] = entry
+        self.size += entry.size
+        brain_id = key[0]
+        for node_id in entry.nodes:
+            self.by_node.setdefault((brain_id, node_id), set()).add(key)
+        while self.size > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= entry.size
+        brain_id = key[0]
+        for node_id in entry.nodes:
+            keys = self.by_node.get((brain_id, node_id), None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.by_node[(brain_id, node_id)]
+
+    def invalidate(self, brain_id, nodes, links=(), attachments=(), brain=False):
+        self.generation += 1
+        for key in [(brain_id, None)] if brain else [(brain_id, node_id) for node_id in nodes]:
+            self.invalidated.pop(key, None)
+            self.invalidated[key] = self.generation
+        while len(self.invalidated) > self.tracked:
+            self.forgotten = self.invalidated.popitem(last=False)[1]
+        if brain:
+            for key in [key for key in self.entries if key[0] == brain_id]:
+                self.evict(key)
+            return
+        for node_id in nodes:
+            for key in list(self.by_node.get((brain_id, node_id), ())):
+                self.evict(key)
+
+    def clear(self):
+        self.entries.clear()
+        self.by_node.clear()
+        self.size = 0
+        self.generation += 1
+        self.invalidated.clear()
+        self.forgotten = self.generation
+
+
+response_cache_size = mbconfig.getint('response_cache_size', 64)
+response_cache = ResponseCache(response_cache_size * 1024 * 1024) if response_cache_size else None
+if response_cache:
+    on_invalidate(response_cache.invalidate)
+    on_clear(response_cache.clear)
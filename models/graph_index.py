@@ -0,0 +1,384 @@
+from heapq import nsmallest
+from itertools import groupby
+from logging import exception
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+from sqlalchemy.future import select
+
+from . import mbconfig
+from .cache import on_invalidate, on_clear
+from .models import Node, Link, Brain, LinkRelation
+from .utils import shared_session_maker, spawn
+
+# the CSR relations of BrainIndex; jumps are directed like their links
+RELATIONS = ('children', 'parents', 'jumps_out', 'jumps_in', 'tags', 'tagged')
+
+
+def csr(n, rows, cols):
+    "The (rows[k], cols[k]) pairs as compressed sparse rows: (indptr, indices)."
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int32)
+    order = np.argsort(rows, kind='stable')
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=n), out=indptr[1:])
+    return indptr, cols[order]
+
+
+class BrainIndex:
+    """The thoughts and links of one brain in memory: thought ids are mapped to
+    dense ints, relations are CSR arrays, and privacy and type are bitmaps.
+
+    The arrays are built once; thoughts reloaded later (when invalidated) are
+    kept in `overlay` with all their relations, and take precedence."""
+
+    def __init__(self, brain_id):
+        self.brain_id = brain_id
+        self.ids = []
+        self.index = {}
+        self.names = []
+        self.size = 0
+        self.private = self.is_type = None
+        self.relations = {}
+        # dense int -> dict(name, private, is_type, children, ...), or None if gone
+        self.overlay = {}
+        # thought id -> generation when last invalidated, until reloaded
+        self.pending = {}
+        self.generation = 0
+
+    def invalidate(self, ids):
+        "Mark these thoughts for reloading, even if a reload of them is running."
+        self.generation += 1
+        self.pending.update(dict.fromkeys(ids, self.generation))
+
+    def reloaded(self, pending):
+        "Forget the `pending` reloaded, unless they were invalidated again since."
+        for (id, generation) in pending.items():
+            if self.pending.get(id, None) == generation:
+                del self.pending[id]
+
+    def dense(self, id):
+        i = self.index.get(id, None)
+        if i is None:
+            i = self.index[id] = len(self.ids)
+            self.ids.append(id)
+        return i
+
+    async def load(self, session):
+        names, private, is_type, tag_pairs = [], [], [], []
+        rows = await session.stream(select(
+            Node.id, Node.name, Node.private, Node.is_type, Node.tags
+        ).filter_by(brain_id=self.brain_id).execution_options(yield_per=10000))
+        async for (id, name, node_private, node_is_type, tags) in rows:
+            self.dense(id)
+            names.append(name)
+            private.append(bool(node_private))
+            is_type.append(bool(node_is_type))
+            if tags:
+                tag_pairs.append((id, tags))
+        self.names = names
+        self.size = n = len(self.ids)
+        self.private = np.array(private, dtype=bool)
+        self.is_type = np.array(is_type, dtype=bool)
+        pairs = {'children': ([], []), 'jumps_out': ([], [])}
+        rows = await session.stream(select(
+            Link.parent_id, Link.child_id, Link.relation
+        ).filter_by(brain_id=self.brain_id).execution_options(yield_per=10000))
+        async for (parent_id, child_id, relation) in rows:
+            parent, child = self.index.get(parent_id), self.index.get(child_id)
+            if parent is None or child is None:
+                continue
+            src, dst = pairs['jumps_out' if relation == LinkRelation.Jump else 'children']
+            src.append(parent)
+            dst.append(child)
+        tagged, tags = [], []
+        for (id, tag_ids) in tag_pairs:
+            for tag_id in tag_ids:
+                if tag_id in self.index:
+                    tagged.append(self.index[id])
+                    tags.append(self.index[tag_id])
+        for (name, inverse, (src, dst)) in (
+                ('children', 'parents', pairs['children']),
+                ('jumps_out', 'jumps_in', pairs['jumps_out']),
+                ('tags', 'tagged', (tagged, tags))):
+            self.relations[name] = csr(n, src, dst)
+            self.relations[inverse] = csr(n, dst, src)
+
+    async def reload(self, session, ids):
+        "Reload these thoughts and all their relations into the overlay."
+        dense = {id: self.dense(id) for id in ids}
+        for i in dense.values():
+            self.overlay[i] = None
+        rows = await session.execute(select(
+            Node.id, Node.name, Node.private, Node.is_type, Node.tags
+        ).filter(Node.brain_id == self.brain_id, Node.id.in_(ids)))
+        for (id, name, private, is_type, tags) in rows:
+            self.overlay[dense[id]] = dict(
+                name=name, private=bool(private), is_type=bool(is_type),
+                tags=[self.dense(tag_id) for tag_id in tags or ()],
+                **{relation: [] for relation in RELATIONS if relation not in ('tags', 'tagged')})
+        rows = await session.execute(select(
+            Link.parent_id, Link.child_id, Link.relation
+        ).filter(Link.brain_id == self.brain_id,
+                 Link.parent_id.in_(ids) | Link.child_id.in_(ids)))
+        for (parent_id, child_id, relation) in rows:
+            parent, child = self.dense(parent_id), self.dense(child_id)
+            forward, backward = ('jumps_out', 'jumps_in') if relation == LinkRelation.Jump else (
+                'children', 'parents')
+            if self.overlay.get(parent) and parent_id in dense:
+                self.overlay[parent][forward].append(child)
+            if self.overlay.get(child) and child_id in dense:
+                self.overlay[child][backward].append(parent)
+
+    def info(self, i):
+        "(name, private, is_type) of a thought, or None if unknown."
+        if i in self.overlay:
+            node = self.overlay[i]
+            return node and (node['name'], node['private'], node['is_type'])
+        if i < self.size:
+            return self.names[i], self.private[i], self.is_type[i]
+
+    def row(self, i, relation):
+        if i >= self.size:
+            return []
+        indptr, indices = self.relations[relation]
+        return indices[indptr[i]:indptr[i + 1]].tolist()
+
+    def related(self, i, relation):
+        if relation == 'tagged':
+            # the tags of reloaded thoughts are only in the overlay
+            return [j for j in self.row(i, relation) if j not in self.overlay] + [
+                j for (j, node) in self.overlay.items() if node and i in node['tags']]
+        if i in self.overlay:
+            return (self.overlay[i] or {}).get(relation, [])
+        return self.row(i, relation)
+
+    def neighbour_sets(self, id, private=False, parents=True, children=True, siblings=True,
+                       jumps=True, tags=True, of_tags=True, same_type=False, **kwargs):
+        "{reln_type: set of dense ints} of the visible neighbours of a thought; None if unknown."
+        i = self.index.get(id, None)
+        if i is None or not self.info(i):
+            return None
+
+        def visible(j):
+            info = self.info(j)
+            return info is not None and (private or not info[1])
+
+        found = {}
+
+        def add(ltype, js):
+            js = set(js)
+            if ltype in ('sibling', 'same_type'):
+                js.discard(i)
+            found.setdefault(ltype, set()).update(j for j in js if visible(j))
+
+        parent_ids = [j for j in self.related(i, 'parents') if visible(j)]
+        if parents:
+            add('parent', parent_ids)
+        if children:
+            add('child', self.related(i, 'children'))
+        for (ltype, shown, types) in (('sibling', siblings, False), ('same_type', same_type, True)):
+            if shown:
+                for p in parent_ids:
+                    if self.info(p)[2] == types:
+                        add(ltype, self.related(p, 'children'))
+        if jumps:
+            add('jump', self.related(i, 'jumps_out') + self.related(i, 'jumps_in'))
+        if tags:
+            add('tag', self.related(i, 'tags'))
+        if of_tags:
+            add('of_tag', self.related(i, 'tagged'))
+        return found
+
+    def neighbour_page(self, id, limit, after=None, **kwargs):
+        """At most limit + 1 (reln_type, id, name) neighbours of each reln_type after
+        the (name, id) in `after`, ordered as Node.get_neighbour_data orders them,
+        and {reln_type: total}; None if unknown. Only a page is sorted, not a hub's
+        thousands of siblings."""
+        found = self.neighbour_sets(id, **kwargs)
+        if found is None:
+            return None
+        after = after or {}
+        rows, counts = [], {}
+        for ltype in sorted(found):
+            counts[ltype] = len(found[ltype])
+            keys = ((self.info(j)[0], self.ids[j]) for j in found[ltype])
+            if ltype in after:
+                keys = (key for key in keys if key > after[ltype])
+            rows.extend((ltype, node_id, name) for (name, node_id) in nsmallest(limit + 1, keys))
+        return rows, counts
+
+    def gate_counts(self, id):
+        "As Node.gate_counts: [children, parents, jumps] of the thought and its neighbours."
+        i = self.index.get(id, None)
+        if i is None:
+            return None
+        ups = self.related(i, 'parents') + self.related(i, 'jumps_in')
+        neighbourhood = {i, *ups, *self.related(i, 'children'), *self.related(i, 'jumps_out')}
+        for p in ups:
+            neighbourhood.update(self.related(p, 'children'))
+            neighbourhood.update(self.related(p, 'jumps_out'))
+        counts = {}
+        for j in neighbourhood:
+            if self.info(j) is None:
+                continue
+            gates = [len(self.related(j, relation))
+                     for relation in ('children', 'parents', 'jumps_out')]
+            if any(gates):
+                counts[self.ids[j]] = gates
+        return counts
+
+    def top_node_id(self):
+        "As Brain.top_node_id, from the arrays as built."
+        if not self.size:
+            return None
+        degree = sum(np.diff(self.relations[relation][0]) for relation in ('children', 'jumps_out'))
+        degree[self.private] = -1
+        i = int(np.argmax(degree))
+        if degree[i] > 0:
+            return self.ids[i]
+
+
+class GraphIndex:
+    """A BrainIndex of each brain, built in the background, and kept current
+    by reloading the thoughts named in invalidations. A brain is only
+    answered for while nothing invalidated is waiting to be reloaded."""
+
+    def __init__(self, rebuild_at=20000):
+        self.rebuild_at = rebuild_at
+        self.brains = {}
+        # brain id -> thought ids invalidated while it was being built
+        self.building = {}
+        # brains that changed wholesale while being built
+        self.outdated = set()
+        self.reloading = set()
+
+    def get(self, brain_id):
+        index = self.brains.get(brain_id, None)
+        if index is not None and not index.pending:
+            return index
+
+    async def start(self):
+        async with shared_session_maker()() as session:
+            brain_ids = list(await session.scalars(select(Brain.id)))
+        for brain_id in brain_ids:
+            self.rebuild(brain_id)
+
+    def rebuild(self, brain_id):
+        if brain_id in self.building:
+            self.outdated.add(brain_id)
+        else:
+            self.building[brain_id] = set()
+            spawn(self.build(brain_id))
+
+    async def build(self, brain_id):
+        index = BrainIndex(brain_id)
+        try:
+            async with shared_session_maker()() as session:
+                await index.load(session)
+        except Exception:
+            exception(f"Could not index brain {brain_id}")
+            return
+        finally:
+            missed = self.building.pop(brain_id)
+        if brain_id in self.outdated:
+            self.outdated.discard(brain_id)
+            self.rebuild(brain_id)
+            return
+        index.invalidate(missed)
+        self.brains[brain_id] = index
+        self.schedule_reload(brain_id)
+
+    def invalidated(self, brain_id, nodes, links=(), attachments=(), brain=False):
+        if brain:
+            # too much may have changed
+            self.brains.pop(brain_id, None)
+            self.rebuild(brain_id)
+            return
+        if brain_id in self.building:
+            self.building[brain_id].update(nodes)
+        index = self.brains.get(brain_id, None)
+        if index is not None:
+            index.invalidate(nodes)
+            self.schedule_reload(brain_id)
+
+    def clear(self):
+        for brain_id in list(self.brains):
+            self.invalidated(brain_id, (), brain=True)
+
+    def schedule_reload(self, brain_id):
+        index = self.brains.get(brain_id, None)
+        if index is not None and index.pending and brain_id not in self.reloading:
+            self.reloading.add(brain_id)
+            spawn(self.reload(brain_id))
+
+    async def reload(self, brain_id):
+        try:
+            while (index := self.brains.get(brain_id, None)) is not None and index.pending:
+                pending = dict(index.pending)
+                async with shared_session_maker()() as session:
+                    await index.reload(session, list(pending))
+                # invalidated again meanwhile stays pending
+                index.reloaded(pending)
+                if len(index.overlay) > self.rebuild_at:
+                    self.rebuild(brain_id)
+        except Exception:
+            exception(f"Could not update the index of brain {brain_id}")
+            self.brains.pop(brain_id, None)
+        finally:
+            self.reloading.discard(brain_id)
+
+
+graph_index = GraphIndex(
+    rebuild_at=mbconfig.getint('graph_index_rebuild_at', 20000),
+) if np is not None and mbconfig.getboolean('graph_index', True) else None
+if graph_index:
+    on_invalidate(graph_index.invalidated)
+    on_clear(graph_index.clear)
+
+
+def neighbour_key(row, full=False):
+    "The (name, id) a neighbour row is ordered by within its reln_type."
+    return (row[1].name, row[1].id) if full else (row[2], row[1])
+
+
+async def neighbour_page(session, node, limit, after=None, full=False, **kwargs):
+    """At most `limit` neighbours of each reln_type, after the (name, id) in `after`
+    for that reln_type, as node.get_neighbour_data gives them; from the graph index
+    when it can answer.
+    Returns (rows, {reln_type: total}, {reln_type: (name, id) to continue after})."""
+    after = after or {}
+    rows = None
+    index = graph_index.get(node.brain_id) if graph_index else None
+    if index is not None and not full and not kwargs.get('text_links') and not kwargs.get('text_backlinks'):
+        found = index.neighbour_page(node.id, limit, after, **kwargs)
+        if found is not None:
+            rows, counts = found
+    if rows is None:
+        rows = await node.get_neighbour_data(session, full, limit=limit, after=after, **kwargs)
+        counts = await node.neighbour_counts(session, **{
+            key: value for (key, value) in kwargs.items() if key != 'with_attachments'})
+    page, cursors = [], {}
+    for (reln_type, group) in groupby(rows, key=lambda row: row[0]):
+        group = list(group)
+        if len(group) > limit:
+            group = group[:limit]
+            cursors[reln_type] = neighbour_key(group[-1], full)
+        page.extend(group)
+    return page, dict(counts), cursors
+
+
+async def node_gate_counts(session, node):
+    index = graph_index.get(node.brain_id) if graph_index else None
+    counts = index.gate_counts(node.id) if index is not None else None
+    if counts is None:
+        counts = await node.gate_counts(session)
+    return counts
+
+
+async def top_node_id(session, brain):
+    index = graph_index.get(brain.id) if graph_index else None
+    node_id = index.top_node_id() if index is not None else None
+    return node_id or await brain.top_node_id(session)
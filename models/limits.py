@@ -0,0 +1,157 @@
+import asyncio
+from time import monotonic
+from weakref import finalize
+
+from . import mbconfig
+
+
+class TokenBucket:
+    "Allows `rate` operations per second on average, with bursts up to `burst`."
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = monotonic()
+
+    def _refill(self):
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, n=1):
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+
+    async def acquire(self, n=1):
+        while not self.try_acquire(n):
+            await asyncio.sleep((n - self.tokens) / self.rate)
+
+
+class Overloaded(Exception):
+    "Too much of this kind of work is already waiting; try again later."
+
+
+class ConcurrencyBudget:
+    """At most `limit` requests at a time, and `max_waiting` waiting for a turn,
+    each for at most `timeout` seconds; beyond that, Overloaded is raised."""
+
+    def __init__(self, name, limit, max_waiting=None, timeout=5.0):
+        self.name = name
+        self.limit = limit
+        self.max_waiting = limit * 4 if max_waiting is None else max_waiting
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(limit)
+        self.active = 0
+        self.waiting = 0
+        self.rejected = 0
+
+    def saturation(self):
+        return self.waiting / self.max_waiting if self.max_waiting else float(self.semaphore.locked())
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_waiting:
+            self.rejected += 1
+            raise Overloaded(self.name)
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise Overloaded(self.name)
+        finally:
+            self.waiting -= 1
+        self.active += 1
+
+    def release(self):
+        self.active -= 1
+        self.semaphore.release()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, *exc):
+        self.release()
+
+    def streaming(self, stream):
+        "Pass an async iterator through, releasing an acquired turn when it ends or is closed."
+        return HeldStream(self, stream)
+
+    def metrics(self):
+        return dict(limit=self.limit, active=self.active, waiting=self.waiting, rejected=self.rejected)
+
+
+class HeldStream:
+    """An async iterator that holds a turn of a budget until the stream is exhausted,
+    fails or is closed, even if it is closed (or dropped) before it was ever iterated,
+    as when the client goes away before the first chunk. It releases only once."""
+
+    def __init__(self, budget, stream):
+        self.stream = stream
+        released = []
+
+        def release():
+            if not released:
+                released.append(True)
+                budget.release()
+        self.release = release
+        finalize(self, release)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.stream.__anext__()
+        except BaseException:
+            await self.aclose()
+            raise
+
+    async def aclose(self):
+        try:
+            if hasattr(self.stream, 'aclose'):
+                await self.stream.aclose()
+        finally:
+            self.release()
+
+
+class AdmissionControl:
+    """Concurrency budgets by kind of route, and a degraded mode: when the wait
+    queue of any budget named in `degrade_on` (by default all) is more than
+    `degrade_at` full, and for `hold` seconds after that, get_node serves what
+    is cached instead of refreshing upstream."""
+
+    def __init__(self, budgets, degrade_at=0.5, hold=30.0, degrade_on=None):
+        self.budgets = {budget.name: budget for budget in budgets}
+        self.degrade_on = [self.budgets[name] for name in (
+            self.budgets if degrade_on is None else degrade_on)]
+        self.degrade_at = degrade_at
+        self.hold = hold
+        self.degraded_until = float('-inf')
+
+    def __getitem__(self, name):
+        return self.budgets[name]
+
+    @property
+    def degraded(self):
+        now = monotonic()
+        if any(budget.saturation() >= self.degrade_at for budget in self.degrade_on):
+            self.degraded_until = now + self.hold
+        return now < self.degraded_until
+
+    def metrics(self):
+        return dict(degraded=self.degraded, **{
+            name: budget.metrics() for (name, budget) in self.budgets.items()})
+
+
+admission = AdmissionControl([
+    ConcurrencyBudget(name, mbconfig.getint(f'admission_{name}', limit),
+                      timeout=mbconfig.getfloat('admission_timeout', 5.0))
+    for (name, limit) in (('thoughts', 32), ('search', 8), ('graph', 8), ('batch', 4), ('export', 2), ('images', 16))
+], hold=mbconfig.getfloat('degraded_hold', 30.0),
+    # the routes that refresh thoughts upstream: a queue of exports is no reason to stop
+    degrade_on=mbconfig.get('degrade_on', 'thoughts,batch').replace(',', ' ').split(),
+) if mbconfig.getboolean('admission_control', True) else None
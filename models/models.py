@@ -1,7 +1,6 @@
 from datetime import datetime
 import enum
 from logging import info
-from itertools import groupby
 
 from isodate import parse_datetime
 from sqlalchemy import (
@@ -12,11 +11,14 @@ from sqlalchemy import (
     String,
     Unicode,
     DateTime,
+    Float,
     Index,
+    Integer,
     Text,
     literal,
     Enum,
     column,
+    union_all,
 )
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.exc import InterfaceError
@@ -132,6 +134,8 @@ class Brain(Base):
     name = Column(Unicode)
     slug = Column(String, unique=True)
     base_id = Column(UUID, nullable=True)
+    # latest modificationDateTime applied by models.reader
+    import_watermark = Column(DateTime)
 
     @property
     def safe_slug(self):
@@ -170,11 +174,23 @@ class Node(Base):
     is_tag = Column(Boolean)
     is_type = Column(Boolean)
     private = Column(Boolean)
+    # decayed view count, maintained by scheduler.RefreshScheduler
+    access_count = Column(Float, server_default='0')
+    last_access = Column(DateTime)
+    # validators of the last /graph response, for conditional refreshes
+    upstream_etag = Column(String)
+    upstream_last_modified = Column(String)
+    # link counts, maintained by bulk.update_link_counts when links are written
+    child_count = Column(Integer, server_default='0')
+    parent_count = Column(Integer, server_default='0')
+    jump_count = Column(Integer, server_default='0')
     brain = relationship(Brain, foreign_keys=[brain_id])
     # siblings = relationship("Node", secondary="Link")
     attachments = relationship("Attachment", back_populates="node")
     child_links = relationship("Link", foreign_keys="Link.parent_id", back_populates="parent")
     parent_links = relationship("Link", foreign_keys="Link.child_id", back_populates="child")
+    # set by utils.get_node when the cached node is served while being revalidated
+    served_stale = False
 
     def get_html_notes(self):
         atts = self.html_attachments
@@ -217,139 +233,143 @@ class Node(Base):
         select(Link.child_id.label('id')).where(Link.parent_id == node_id),
         select(Link.child_id.label('id')).join(sibling_link, sibling_link.parent_id == Link.parent_id).where(sibling_link.child_id == node_id)).cte()
 
-        r = await session.execute(select(
-        literal('child').label('reln_type'),
-        Node.id,
-        count(Link.child_id)
-        ).join(Link, Link.parent_id == Node.id
-        ).filter(Node.id.in_(select(neighbours.c.id)), Link.relation != LinkRelation.Jump
-        ).group_by(Node.id).union_all(
-        select(
-            literal('parent').label('reln_type'),
-            Node.id,
-            count(Link.parent_id)
-            ).join(Link, Link.child_id == Node.id
-            ).filter(Node.id.in_(select(neighbours.c.id)), Link.relation != LinkRelation.Jump
-            ).group_by(Node.id),
-        select(
-            literal('jump').label('reln_type'),
-            Node.id,
-            count(Link.child_id)
-            ).join(Link, Link.parent_id == Node.id
-            ).filter(Node.id.in_(select(neighbours.c.id)), Link.relation == LinkRelation.Jump
-            ).group_by(Node.id)).order_by(Node.id, 'reln_type'))
+        return await Node.gate_counts_of(session, select(neighbours.c.id))
 
-        counts = {}
-
-        for node_id, data in groupby(r, lambda row: row[1]):
-            data = dict([(name, count) for (name, _, count) in data])
-            counts[node_id] = [data.get(name, 0) for name in ('child', 'parent', 'jump')]
-        return counts
-
-    async def get_neighbour_data(
-            self, session, full=False, with_links=False, private=False,
+    @classmethod
+    async def gate_counts_of(cls, session, ids):
+        "{id: [children, parents, jumps]} of the given nodes (ids, or a select of ids) that have links."
+        rows = await session.execute(select(
+            cls.id, cls.child_count, cls.parent_count, cls.jump_count
+        ).filter(cls.id.in_(ids),
+                 (cls.child_count > 0) | (cls.parent_count > 0) | (cls.jump_count > 0)))
+        return {id: [children, parents, jumps] for (id, children, parents, jumps) in rows}
+
+    def neighbour_queries(
+            self, entities, with_links=False, private=False,
             parents=True, children=True, siblings=True,
             jumps=True, tags=True, of_tags=True, text_links=False,
-            text_backlinks=False, with_attachments=False, same_type=False):
+            text_backlinks=False, same_type=False):
+        """The queries of each kind of neighbour, with (reln_type, *entities[, link_id])
+        columns, as (reln_type, query). Each neighbour is in a query at most once."""
         queries = []
-        #import pdb; pdb.set_trace()
-        node_id = Node.id.label('node_id')
-        node_name = Node.name.label('node_name')
-        entities = [node_id, node_name]
-        if with_links:
-            entities.append(Link.id.label('link_id'))
-        if parents or siblings or same_type:
+        link_id = [Link.id.label('link_id')] if with_links else []
+        if parents:
             parent_query = select(
-                literal('parent').label('reln_type'), *entities).join(
+                literal('parent').label('reln_type'), *entities, *link_id).join(
                 Link, Node.child_links).filter(
                 (Link.child_id == self.id) & (Link.relation != LinkRelation.Jump))
             if not private:
                 parent_query = parent_query.filter(Node.private == False)
-        if parents:
-            queries.append(parent_query)
+            queries.append(('parent', parent_query))
         if children:
             query = select(
-                literal('child').label('reln_type'), *entities).join(
+                literal('child').label('reln_type'), *entities, *link_id).join(
                 Link, Node.parent_links).filter(
                 (Link.parent_id == self.id) & (Link.relation != LinkRelation.Jump))
             if not private:
                 query = query.filter(Node.private == False)
-            queries.append(query)
-        if siblings:
-            subquery = parent_query.filter(Node.is_type == False).with_only_columns(Node.id).subquery()
-            query = select(
-                literal('sibling').label('reln_type'), *entities).join(
-                Link, Node.parent_links).filter(
-                Link.parent_id.in_(select(subquery)) &
-                (Node.id != self.id) & (Link.relation != LinkRelation.Jump))
+            queries.append(('child', query))
+        for (reln_type, shown, types) in (('sibling', siblings, False), ('same_type', same_type, True)):
+            if not shown:
+                continue
+            # children of the parents, each once, however many parents they share
+            parent = aliased(Node)
+            parent_ids = select(parent.id).join(Link, Link.parent_id == parent.id).filter(
+                (Link.child_id == self.id) & (Link.relation != LinkRelation.Jump) &
+                (parent.is_type == types))
             if not private:
-                query = query.filter(Node.private == False)
-            queries.append(query)
-        if same_type:
-            subquery = parent_query.filter(Node.is_type == True).with_only_columns(Node.id).subquery()
-            query = select(
-                literal('same_type').label('reln_type'), *entities).join(
-                Link, Node.parent_links).filter(
-                Link.parent_id.in_(select(subquery)) &
-                (Node.id != self.id) & (Link.relation != LinkRelation.Jump))
+                parent_ids = parent_ids.filter(parent.private == False)
+            sibling_link = aliased(Link)
+            linked = select(sibling_link.child_id).filter(
+                sibling_link.parent_id.in_(parent_ids) & (sibling_link.relation != LinkRelation.Jump))
+            columns = list(entities)
+            if with_links:
+                # one of the links to a shared parent
+                columns.append(linked.with_only_columns(sibling_link.id).filter(
+                    sibling_link.child_id == Node.id).limit(1).scalar_subquery().label('link_id'))
+            query = select(literal(reln_type).label('reln_type'), *columns).filter(
+                Node.id.in_(linked) & (Node.id != self.id))
             if not private:
                 query = query.filter(Node.private == False)
-            queries.append(query)
+            queries.append((reln_type, query))
         if jumps:
             query = select(
-                literal('jump').label('reln_type'), *entities).join(
+                literal('jump').label('reln_type'), *entities, *link_id).join(
                 Link, Node.parent_links).filter(
                 (Link.parent_id == self.id) & (Link.relation == LinkRelation.Jump))
             if not private:
                 query = query.filter(Node.private == False)
-            queries.append(query)
+            queries.append(('jump', query))
             query = select(
-                literal('jump').label('reln_type'), *entities).join(
+                literal('jump').label('reln_type'), *entities, *link_id).join(
                 Link, Node.child_links).filter(
                 (Link.child_id == self.id) & (Link.relation == LinkRelation.Jump))
             if not private:
                 query = query.filter(Node.private == False)
-            queries.append(query)
+            queries.append(('jump', query))
         if tags and self.tags:
             query = select(
-                literal('tag').label('reln_type'), *entities).filter(Node.id.in_(self.tags))
+                literal('tag').label('reln_type'), *entities, *link_id).filter(Node.id.in_(self.tags))
             if not private:
                 query = query.filter(Node.private == False)
             if with_links:
                 query = query.outerjoin(Link, Link.id == None)
-            queries.append(query)
+            queries.append(('tag', query))
         if of_tags:
             query = select(
-                literal('of_tag').label('reln_type'), *entities).filter(Node.tags.contains([self.id]))
+                literal('of_tag').label('reln_type'), *entities, *link_id).filter(Node.tags.contains([self.id]))
             if not private:
                 query = query.filter(Node.private == False)
             if with_links:
                 query = query.outerjoin(Link, Link.id == None)
-            queries.append(query)
+            queries.append(('of_tag', query))
         if text_links and self.text_links:
             query = select(
-                literal('text_link').label('reln_type'), *entities).filter(
-                    Node.id.in_(self.text_links), Node.brain_id==self.brain.id)
+                literal('text_link').label('reln_type'), *entities, *link_id).filter(
+                    Node.id.in_(self.text_links), Node.brain_id==self.brain_id)
             if not private:
                 query = query.filter(Node.private == False)
             if with_links:
                 query = query.outerjoin(Link, Link.id == None)
-            queries.append(query)
+            queries.append(('text_link', query))
         if text_backlinks:
             query = select(
-                literal('text_backlink').label('reln_type'), *entities).filter(
-                    Node.text_links.contains([self.id]), Node.brain_id==self.brain.id)
+                literal('text_backlink').label('reln_type'), *entities, *link_id).filter(
+                    Node.text_links.contains([self.id]), Node.brain_id==self.brain_id)
             if not private:
                 query = query.filter(Node.private == False)
             if with_links:
                 query = query.outerjoin(Link, Link.id == None)
+            queries.append(('text_backlink', query))
+        return queries
+
+    async def get_neighbour_data(
+            self, session, full=False, with_links=False, with_attachments=False,
+            limit=None, after=None, **kwargs):
+        """(reln_type, node_id, node_name[, link_id]) of the neighbours, or with `full`
+        (reln_type, Node[, Link]), ordered by reln_type, name and id.
+        Names are ordered by code point (the C collation), as Python sorts them,
+        so that cursors from the graph index or from fresh data hold here too.
+        With `limit`, at most limit + 1 of each query, so callers can tell there is more;
+        `after` maps a reln_type to the (name, id) of the last neighbour already shown."""
+        node_id = Node.id.label('node_id')
+        name = Node.name.collate('C')
+        node_name = name.label('node_name')
+        entities = [node_id, node_name]
+        queries = []
+        for (reln_type, query) in self.neighbour_queries(entities, with_links, **kwargs):
+            if after and reln_type in after:
+                (after_name, after_id) = after[reln_type]
+                query = query.filter((name > after_name) | ((name == after_name) & (Node.id > after_id)))
+            if limit is not None:
+                query = query.order_by(name, Node.id).limit(limit + 1)
             queries.append(query)
         if not queries:
             return []
         query = queries.pop()
         if queries:
             query = query.union_all(*queries)
-        query = query.order_by(column("reln_type"), node_name)
+        query = query.order_by(column("reln_type"), node_name, node_id)
         if full:
             subq = query.cte()
             sNode = aliased(Node)
@@ -358,9 +378,11 @@ class Node(Base):
             if with_links:
                 fentities.append(sLink)
             query = select(subq.c.reln_type, *fentities)
-            query = query.join_from(subq, sNode, sNode.id == subq.c.node_id)
+            query = query.join_from(subq, sNode, sNode.id == subq.c.node_id).order_by(
+                subq.c.reln_type, subq.c.node_name, subq.c.node_id)
             if with_links:
-                query = query.join_from(subq, sLink, sLink.id == subq.c.link_id)
+                # tags have no link
+                query = query.join_from(subq, sLink, sLink.id == subq.c.link_id, isouter=True)
             if with_attachments:
                 query = query.options(
                     joinedload(sNode.html_attachments),
@@ -368,14 +390,28 @@ class Node(Base):
                     subqueryload(sNode.url_link_attachments))
         return (await session.execute(query)).unique()
 
+    async def neighbour_counts(self, session, **kwargs):
+        "{reln_type: number of neighbours} of the kinds get_neighbour_data gives, in one statement."
+        queries = [
+            select(literal(reln_type).label('reln_type'), count().label('total')).select_from(
+                query.subquery())
+            for (reln_type, query) in self.neighbour_queries([Node.id], **kwargs)]
+        if not queries:
+            return {}
+        counts = {}
+        for (reln_type, total) in await session.execute(union_all(*queries)):
+            counts[reln_type] = counts.get(reln_type, 0) + total
+        return counts
+
     @classmethod
     def create_from_json(cls, data, focus=False):
         from .utils import extract_text_links_from_data
         data_time = parse_datetime(max(filter(None, [
             data['modificationDateTime'], data.get('linksModificationDateTime', None)])))
-        tags = data.pop('tags', None)
-        if tags:
-            tags = [t['id'] for t in tags]
+        # None when not given, as for other thoughts than the focus
+        tags = None
+        if 'tags' in data:
+            tags = [t['id'] for t in data.pop('tags') or ()]
         return cls(
             id=data['id'],
             brain_id=data['brainId'],
@@ -420,10 +456,8 @@ class Node(Base):
         if data_time <= self.last_modified and not force:
             return
         self.brain_id = data['brainId']
-        tags = data.pop('tags', None)
-        if tags:
-            tags = [t['id'] for t in tags]
-            self.tags = tags
+        if 'tags' in data:
+            self.tags = [t['id'] for t in data.pop('tags') or ()]
         if focus:
             from .utils import extract_text_links_from_data
             self.text_links = extract_text_links_from_data(data)
@@ -650,7 +684,7 @@ class Attachment(Base):
             return
         if (self.text_content or self.content) and not force:
             return
-        contentr = await httpx.get(self.brain_uri(), follow_redirects=True)
+        contentr = await httpx.get(self.brain_uri(), brain_id=self.brain_id, follow_redirects=True)
         if contentr.is_success:
             self.set_content(contentr.content)
 
@@ -0,0 +1,126 @@
+import asyncio
+from collections import Counter, OrderedDict
+from logging import exception
+
+from sqlalchemy import union_all
+from sqlalchemy.future import select
+from sqlalchemy.sql import literal
+
+from . import mbconfig
+from .models import Node, Link, LinkRelation
+from .limits import TokenBucket
+from .utils import (
+    refresh_node, shared_session_maker, spawn, IN_FLIGHT, upstream, pool_size, max_overflow)
+from .upstream import UpstreamUnavailable
+from .limits import admission
+
+
+def prefetch_candidates(node, data=None):
+    """Neighbours a reader is likely to visit next: children, then jumps.
+    From fresh graph data if given, else None: they are then queried by the prefetch."""
+    if data:
+        # fresh graph data, maybe not stored yet
+        return data['root'].get('children', []) + data['root'].get('jumps', [])
+
+
+def candidates_query(node_id, limit):
+    "At most `limit` children, then jumps, of a thought; hubs may have thousands."
+    jump = Link.relation == LinkRelation.Jump
+    linked = union_all(
+        select(Link.child_id.label('id'), literal(0).label('rank')).filter(
+            Link.parent_id == node_id, ~jump),
+        select(Link.child_id, literal(1)).filter(Link.parent_id == node_id, jump),
+        select(Link.parent_id, literal(1)).filter(Link.child_id == node_id, jump),
+    ).subquery()
+    return select(linked.c.id).order_by(linked.c.rank).limit(limit)
+
+
+class Prefetcher:
+    """Warms neighbours of viewed thoughts that were never read as focus,
+    through the same refresh path as get_node."""
+
+    def __init__(self, concurrency=4, rate=2.0, per_view=5, max_pending=100, tracked=10000):
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.rate = rate
+        self.per_view = per_view
+        self.max_pending = max_pending
+        self.tracked = tracked
+        self.buckets = {}
+        self.pending = 0
+        # (brain_id, node_id) of prefetched nodes not viewed yet
+        self.warm = OrderedDict()
+        self.stats = Counter()
+
+    def bucket(self, brain_id):
+        if brain_id not in self.buckets:
+            self.buckets[brain_id] = TokenBucket(self.rate)
+        return self.buckets[brain_id]
+
+    def record_view(self, brain_id, id):
+        self.stats['views'] += 1
+        if self.warm.pop((brain_id, id), False) is not False:
+            self.stats['hits'] += 1
+
+    def wanted(self, brain_id, candidates):
+        return [id for id in candidates
+                if (brain_id, id) not in self.warm and (brain_id, id) not in IN_FLIGHT]
+
+    def after_view(self, brain_id, node, data=None):
+        candidates = prefetch_candidates(node, data)
+        if candidates is not None:
+            candidates = self.wanted(brain_id, candidates)
+        if admission and admission.degraded:
+            return
+        if candidates != [] and self.pending < self.max_pending and upstream.available():
+            self.pending += 1
+            spawn(self.prefetch(brain_id, node.id, candidates))
+
+    async def prefetch(self, brain_id, node_id, candidates=None):
+        try:
+            # waiting prefetches hold no pooled connection
+            async with self.semaphore, shared_session_maker()() as session:
+                if candidates is None:
+                    candidates = self.wanted(brain_id, await session.scalars(
+                        candidates_query(node_id, self.per_view * 4)))
+                    if not candidates:
+                        return
+                cold = await session.scalars(select(Node.id).filter(
+                    Node.id.in_(candidates), Node.brain_id == brain_id,
+                    Node.read_as_focus == False, Node.private == False))
+                cold = set(cold)
+                cold = [id for id in candidates if id in cold][:self.per_view]
+                for id in cold:
+                    if not self.bucket(brain_id).try_acquire():
+                        self.stats['rate_limited'] += len(cold) - cold.index(id)
+                        break
+                    try:
+                        data, fetched = await refresh_node(session, brain_id, id)
+                    except UpstreamUnavailable:
+                        self.stats['upstream_unavailable'] += 1
+                        break
+                    if data:
+                        self.stats['prefetched'] += 1
+                        self.warm[(brain_id, id)] = True
+                        while len(self.warm) > self.tracked:
+                            self.warm.popitem(last=False)
+        except Exception:
+            self.stats['errors'] += 1
+            exception("Prefetch failed")
+        finally:
+            self.pending -= 1
+
+    def metrics(self):
+        prefetched = self.stats['prefetched']
+        return dict(
+            self.stats,
+            pending=self.pending,
+            hit_rate=self.stats['hits'] / prefetched if prefetched else None)
+
+
+prefetcher = Prefetcher(
+    # each running prefetch holds a connection: leave most of the pool to requests
+    concurrency=max(1, min(mbconfig.getint('prefetch_concurrency', 4), pool_size // 2)),
+    rate=mbconfig.getfloat('prefetch_rate', 2.0),
+    per_view=mbconfig.getint('prefetch_per_view', 5),
+    max_pending=min(mbconfig.getint('prefetch_max_pending', 100), pool_size + max_overflow),
+) if mbconfig.getboolean('prefetch', True) else None
@@ -1,65 +1,290 @@
 import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import islice
+from os import cpu_count
+from pathlib import Path
+from time import monotonic
+import re
+import zipfile
 
+from isodate import parse_datetime
 import simplejson as json
+from sqlalchemy import delete
+from sqlalchemy.future import select
 
-from .models import Node, Link, Attachment, AttachmentType
-from .utils import get_brain, get_session, lcase_json, get_session
+from . import mbconfig
+from .models import Brain, Node, Link, Attachment, AttachmentType
+from .utils import get_brain, get_session, lcase_json
+from .bulk import (
+    BulkLoader, as_record, naive_utc, record_last_modified, update_link_counts, BATCH_SIZE)
+from .bus import notify_in_transaction
+from .surrogate import purger, brain_key
 
+CHUNK_SIZE = 500
+# the files read_brain needs in an export
+EXPORT_FILES = ("meta.json", "thoughts.json", "links.json", "attachments.json")
+ID_RE = re.compile(r'"Id"\s*:\s*"([^"]+)"')
+MODIFIED_RE = re.compile(r'"(?:Links)?ModificationDateTime"\s*:\s*"([^"]+)"')
+# export root, opened once per worker process
+_base = None
 
-async def read_brain(base):
+
+def open_export(path):
+    path = Path(path)
+    if zipfile.is_zipfile(path):
+        return zipfile.Path(zipfile.ZipFile(path.open('rb')))
+    if not path.is_dir():
+        raise ValueError(f"Not a brain export (a directory or zip file): {path}")
+    return path
+
+
+def _init_worker(path):
+    global _base
+    _base = open_export(path)
+
+
+def read_attachment_content(base, att):
+    if att['Type'] in (
+            AttachmentType.ExternalFile.value,
+            AttachmentType.ExternalUrl.value,
+            AttachmentType.ExternalDirectory.value):
+        return None
+    contentf = base / att["SourceId"] / att["Location"]
+    if not contentf.exists():
+        contentf = base / att["SourceId"] / "Notes" / att["Location"]
+        if not contentf.exists():
+            return None
+    with contentf.open(mode='rb') as f:
+        return f.read()
+
+
+def unchanged_id(line, watermark):
+    """The id of the record on this line if it is known not to be newer than
+    the watermark, found without decoding the whole line."""
+    if watermark is None:
+        return None
+    dates = MODIFIED_RE.findall(line)
+    id = ID_RE.search(line)
+    # compared as datetimes: the strings may differ in precision and offset
+    if dates and id and max(naive_utc(parse_datetime(date)) for date in dates) <= watermark:
+        return id.group(1)
+
+
+# The parse_* functions run in the worker processes:
+# they turn a chunk of export lines into rows ready for COPY.
+# Records that did not change since the watermark are returned without a row.
+
+def parse_nodes(lines, watermark=None):
+    acc = []
+    for line in lines:
+        id = unchanged_id(line, watermark)
+        if id:
+            acc.append((id, None))
+            continue
+        node = Node.create_from_json(lcase_json(json.loads(line)), True)
+        acc.append((node.id, as_record(node)))
+    return acc
+
+
+def parse_links(lines, watermark=None):
+    acc = []
+    for line in lines:
+        id = unchanged_id(line, watermark)
+        if id:
+            acc.append((id, None, None, None))
+            continue
+        link = Link.create_from_json(lcase_json(json.loads(line)))
+        acc.append((link.id, link.parent_id, link.child_id, as_record(link)))
+    return acc
+
+
+def parse_attachments(lines, watermark=None):
+    acc = []
+    for line in lines:
+        id = unchanged_id(line, watermark)
+        if id:
+            acc.append((id, None, None))
+            continue
+        att = json.loads(line)
+        # reading, decoding, cleaning and language detection all happen here
+        content = read_attachment_content(_base, att)
+        att = Attachment.create_from_json(lcase_json(att), content)
+        acc.append((att.id, att.node_id, as_record(att)))
+    return acc
+
+
+class Progress:
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self.start = self.last = monotonic()
+        self.counts = {}
+
+    def update(self, name, n):
+        self.counts[name] = self.counts.get(name, 0) + n
+        now = monotonic()
+        if now - self.last >= self.interval:
+            self.last = now
+            self.report()
+
+    def report(self):
+        elapsed = max(monotonic() - self.start, 1e-6)
+        total = sum(self.counts.values())
+        detail = ", ".join(f"{name}: {n}" for (name, n) in self.counts.items())
+        print(f"{detail} ({total / elapsed:.0f} records/s, {elapsed:.0f}s)")
+
+
+async def pipeline(base, fname, pool, parse, consume, progress,
+                   chunk_size=CHUNK_SIZE, depth=4):
+    "Parse chunks of a file in the pool, feeding results in order to consume."
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=depth)
+
+    async def produce():
+        with (base / fname).open() as f:
+            while True:
+                chunk = list(islice(f, chunk_size))
+                if not chunk:
+                    break
+                await queue.put(loop.run_in_executor(pool, parse, chunk))
+        await queue.put(None)
+
+    producer = asyncio.create_task(produce())
+    try:
+        while (future := await queue.get()) is not None:
+            rows = await future
+            for row in rows:
+                await consume(*row)
+            progress.update(fname, len(rows))
+        await producer
+    finally:
+        producer.cancel()
+
+
+async def read_brain(path, force=False, workers=None, incremental=False):
+    base = open_export(path)
+    # before starting the workers, which would fail on the first missing file
+    missing = [fname for fname in EXPORT_FILES if not (base / fname).exists()]
+    if missing:
+        raise ValueError(f"Not a brain export, missing {', '.join(missing)}: {path}")
+    workers = workers or mbconfig.getint('import_workers', 0) or cpu_count()
     session = get_session()
+    progress = Progress()
     node_ids = set()
+    link_ids = set()
+    attachment_ids = set()
+    latest = None
     with (base / "meta.json").open() as f:
         meta = json.load(f)
         brain_id = meta["BrainId"]
-        brain = get_brain(session, brain_id)
-    with (base / "thoughts.json").open() as f:
-        for line in f:
-            node = json.loads(line)
-            node_ids.add(node["Id"])
-            node = await Node.create_or_update_from_json(session, lcase_json(node), True)
-            session.add(node)
-    with (base / "links.json").open() as f:
-        for line in f:
-            link = json.loads(line)
-            if link['ThoughtIdA'] not in node_ids or \
-                    link['ThoughtIdB'] not in node_ids:
-                print("Missing link: ", link["Id"], link["ThoughtIdA"], link["ThoughtIdB"])
-                continue
-            link = await Link.create_or_update_from_json(session, lcase_json(link))
-            session.add(link)
-    with (base / "attachments.json").open() as f:
-        for line in f:
-            att = json.loads(line)
-            if att["SourceId"] not in node_ids:
-                print("Missing attachment: ", att["Id"], att["SourceId"])
-                continue
-            content = None
-            if att['Type'] not in (
-                    AttachmentType.ExternalFile.value,
-                    AttachmentType.ExternalUrl.value,
-                    AttachmentType.ExternalDirectory.value):
-                contentf = base / att["SourceId"] / att["Location"]
-                if contentf.exists():
-                    with contentf.open(mode='rb') as f2:
-                        content = f2.read()
-                else:
-                    contentf = base / att["SourceId"] / "Notes" / att["Location"]
-                    if contentf.exists():
-                        with contentf.open(mode='rb') as f2:
-                            content = f2.read()
-            att = await Attachment.create_or_update_from_json(
-                session, lcase_json(att), content)
-            session.add(att)
+        brain = await get_brain(session, brain_id)
+    watermark = brain.import_watermark if incremental and not force else None
+    loader = BulkLoader(session, force=force, track_link_ends=watermark is not None)
+
+    async def add(tbl, id, record):
+        nonlocal latest
+        modified = record_last_modified(tbl, record)
+        if modified and (latest is None or modified > latest):
+            latest = modified
+        await loader.add_record(tbl, id, record)
+
+    async def add_node(id, record):
+        node_ids.add(id)
+        if record:
+            await add(Node.__table__, id, record)
+
+    async def add_link(id, parent_id, child_id, record):
+        link_ids.add(id)
+        if not record:
+            return
+        if parent_id not in node_ids or child_id not in node_ids:
+            print("Missing link: ", id, parent_id, child_id)
+            return
+        await add(Link.__table__, id, record)
+
+    async def add_attachment(id, source_id, record):
+        attachment_ids.add(id)
+        if not record:
+            return
+        if source_id not in node_ids:
+            print("Missing attachment: ", id, source_id)
+            return
+        await add(Attachment.__table__, id, record)
+
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=(str(path),)) as pool:
+        depth = 2 * workers
+        await pipeline(base, "thoughts.json", pool, partial(parse_nodes, watermark=watermark),
+                       add_node, progress, depth=depth)
+        await pipeline(base, "links.json", pool, partial(parse_links, watermark=watermark),
+                       add_link, progress, depth=depth)
+        await pipeline(base, "attachments.json", pool, partial(parse_attachments, watermark=watermark),
+                       add_attachment, progress, depth=depth)
+    await loader.flush()
+    if watermark is not None:
+        # every record of the export was seen, changed or not: what is stored and
+        # no longer in it was deleted, unless it changed after the export was made
+        # (cached from the API since)
+        exported = max(filter(None, (latest, watermark)))
+        for cls, present in ((Attachment, attachment_ids), (Link, link_ids), (Node, node_ids)):
+            ids = set(await session.scalars(select(cls.id).filter(
+                cls.brain_id == brain.id,
+                cls.last_modified.is_(None) | (cls.last_modified <= exported)))) - present
+            ids = sorted(ids)
+            for i in range(0, len(ids), BATCH_SIZE):
+                chunk = ids[i:i + BATCH_SIZE]
+                if cls is Node:
+                    # their links go with them
+                    loader.link_ends.update(end for ends in await session.execute(select(
+                        Link.parent_id, Link.child_id).filter(
+                        Link.parent_id.in_(chunk) | Link.child_id.in_(chunk))) for end in ends)
+                stmt = delete(cls).where(cls.id.in_(chunk), cls.brain_id == brain.id)
+                if cls is Link:
+                    stmt = stmt.returning(Link.parent_id, Link.child_id)
+                result = await session.execute(stmt)
+                if cls is Link:
+                    loader.link_ends.update(end for ends in result for end in ends)
+            if ids:
+                loader.counts[f"deleted_{cls.__tablename__}"] = len(ids)
+    if watermark is not None:
+        # only the ends of links written or deleted
+        updated = await update_link_counts(session, brain.id, loader.link_ends)
+    else:
+        updated = await update_link_counts(session, brain.id)
+    loader.counts['link_counts'] = len(updated)
+    if latest and (brain.import_watermark is None or latest > brain.import_watermark):
+        brain.import_watermark = latest
+    # web workers drop what they cached about this brain once we commit
+    await notify_in_transaction(session, brain.id, brain=True)
     await session.commit()
+    if purger:
+        # and the proxy, every page of the brain
+        await purger.purge([brain_key(brain.id)])
+    progress.report()
+    return loader.counts
+
+
+async def repair_link_counts(brain_ids=None):
+    """Recompute the stored link counts of these brains (by default all of them),
+    in one transaction per brain. Returns how many nodes were fixed per brain."""
+    session = get_session()
+    if not brain_ids:
+        brain_ids = list(await session.scalars(select(Brain.id)))
+    fixed = {}
+    for brain_id in brain_ids:
+        ids = await update_link_counts(session, brain_id)
+        if ids:
+            await notify_in_transaction(session, brain_id, nodes=ids)
+        await session.commit()
+        if ids and purger:
+            await purger.purge(sorted(ids))
+        fixed[brain_id] = len(ids)
+    await session.close()
+    return fixed
 
 if __name__ == '__main__':
     from sys import argv
-    import zipfile
-    from pathlib import Path
-    root = Path(argv[1])
-    if zipfile.is_zipfile(root):
-        root = zipfile.Path(zipfile.ZipFile(root.open('rb')))
+    args = [arg for arg in argv[1:] if not arg.startswith('--')]
+    if '--repair-counts' in argv:
+        print(asyncio.run(repair_link_counts(args)))
     else:
-        assert root.is_dir()
-    asyncio.run(read_brain(root))
+        print(asyncio.run(read_brain(args[0], incremental='--incremental' in argv)))
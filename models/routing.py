@@ -0,0 +1,74 @@
+from random import choice
+from time import monotonic
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.sql import Select
+
+from .cache import on_invalidate
+
+
+class RoutingSession(Session):
+    """Sends plain SELECTs to one of the replicas, and anything else to the primary.
+
+    Once a session has written, it stays on the primary, to read its own writes.
+    For `lag` seconds after rows of a brain were written, by this process or by
+    another (see written), sessions reading that brain (see for_brain) read from
+    the primary too, so that a page fetched right after a refresh does not miss
+    it because of replication lag."""
+
+    primary = None
+    replicas = ()
+    lag = 5.0
+    # brain id (None for all brains) -> monotonic time of its last write
+    last_write = {}
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.replica = choice(self.replicas) if self.replicas else None
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._flushing or not self.is_read(clause):
+            self.wrote = True
+            return self.primary
+        if self.wrote or self.replica is None or self.recently_written():
+            return self.primary
+        return self.replica
+
+    def recently_written(self):
+        now = monotonic()
+        return any(now - self.last_write.get(key, float('-inf')) < self.lag
+                   for key in (None, self.info.get('brain_id', None)))
+
+    @staticmethod
+    def is_read(clause):
+        return isinstance(clause, Select) and clause._for_update_arg is None
+
+
+def written(brain_id=None):
+    """Rows of this brain (of any brain if None) were written and committed:
+    its sessions read from the primary for the next `lag` seconds."""
+    RoutingSession.last_write[brain_id] = monotonic()
+
+
+@on_invalidate
+def _invalidated(brain_id, nodes, links=(), attachments=(), brain=False):
+    # the brain row itself is also read without a brain
+    written(None if brain else brain_id)
+
+
+def for_brain(session, brain):
+    "Route the reads of this session as reads of this brain."
+    if brain is not None:
+        session.info['brain_id'] = brain.id
+    return brain
+
+
+def routing_session_maker(primary, replicas, lag=5.0, **options):
+    "An AsyncSession maker that routes between async engines, as RoutingSession does."
+    session_class = type('RoutingSession', (RoutingSession,), dict(
+        primary=primary.sync_engine,
+        replicas=[engine.sync_engine for engine in replicas],
+        lag=lag))
+    return sessionmaker(class_=AsyncSession, sync_session_class=session_class, **options)
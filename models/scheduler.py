@@ -0,0 +1,103 @@
+import asyncio
+from collections import Counter
+from datetime import timedelta
+from logging import exception
+
+from sqlalchemy import update, bindparam
+from sqlalchemy.future import select
+from sqlalchemy.sql import func
+
+from . import mbconfig
+from .models import Node
+from .utils import refresh_node, shared_session_maker, spawn, upstream
+
+
+class RefreshScheduler:
+    """Keeps popular thoughts fresh before anyone hits a stale node.
+
+    Views are counted in memory and flushed to `Node.access_count` in one
+    batched statement per interval; the count decays with the given half-life.
+    Each interval, up to `budget` focus nodes are refreshed upstream,
+    in order of popularity × staleness."""
+
+    def __init__(self, interval=60, budget=30, half_life=timedelta(days=7),
+                 min_age=timedelta(hours=12), concurrency=2):
+        self.interval = interval
+        self.budget = budget
+        self.half_life = half_life.total_seconds()
+        self.min_age = min_age
+        self.concurrency = concurrency
+        self.hits = Counter()
+        self.task = None
+
+    def record_access(self, brain_id, id):
+        self.hits[(brain_id, id)] += 1
+
+    def decayed(self, since):
+        return func.power(0.5, func.coalesce(
+            func.extract('epoch', func.localtimestamp() - since), 0) / self.half_life)
+
+    def priority(self):
+        staleness = func.extract('epoch', func.localtimestamp() - Node.last_read)
+        return Node.access_count * self.decayed(Node.last_access) * staleness
+
+    async def flush(self, session):
+        hits, self.hits = self.hits, Counter()
+        if not hits:
+            return
+        node = Node.__table__
+        await session.execute(update(node).where(
+            (node.c.id == bindparam('node_id')) & (node.c.brain_id == bindparam('node_brain_id'))
+        ).values(
+            access_count=func.coalesce(node.c.access_count, 0) * self.decayed(node.c.last_access)
+                + bindparam('hits'),
+            last_access=func.localtimestamp()),
+            [dict(node_brain_id=brain_id, node_id=id, hits=n)
+             for ((brain_id, id), n) in hits.items()])
+        await session.commit()
+
+    async def refresh_popular(self, session):
+        rows = await session.execute(select(Node.brain_id, Node.id).filter(
+            Node.access_count > 0, Node.read_as_focus == True, Node.private == False,
+            Node.last_read < func.localtimestamp() - self.min_age,
+        ).order_by(self.priority().desc()).limit(self.budget))
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def refresh(brain_id, id):
+            async with semaphore:
+                async with shared_session_maker()() as session:
+                    await refresh_node(session, brain_id, id)
+
+        results = await asyncio.gather(*[refresh(brain_id, id) for (brain_id, id) in rows],
+                                       return_exceptions=True)
+        for e in results:
+            if isinstance(e, Exception):
+                exception("Scheduled refresh failed", exc_info=e)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                async with shared_session_maker()() as session:
+                    await self.flush(session)
+                    if upstream.available():
+                        await self.refresh_popular(session)
+            except Exception:
+                exception("Refresh scheduler failed")
+
+    def start(self):
+        self.task = spawn(self.run())
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            self.task = None
+        async with shared_session_maker()() as session:
+            await self.flush(session)
+
+
+scheduler = RefreshScheduler(
+    interval=mbconfig.getint('refresh_interval', 60),
+    budget=mbconfig.getint('refresh_budget', 30),
+    half_life=timedelta(days=mbconfig.getfloat('popularity_half_life', 7)),
+) if mbconfig.getboolean('refresh_scheduler', True) else None
@@ -0,0 +1,82 @@
+import asyncio
+from logging import exception
+
+import httpx
+
+from . import mbconfig
+from .cache import on_publish
+from .utils import spawn
+
+# how long browsers and a fronting proxy may keep thought pages
+browser_max_age = mbconfig.getint('browser_max_age', 60)
+proxy_max_age = mbconfig.getint('proxy_max_age', 86400)
+# longest Surrogate-Key header, under the header size limits of proxies (8 KB for Varnish)
+surrogate_key_max = mbconfig.getint('surrogate_key_max', 4000)
+
+
+def brain_key(brain_id):
+    return f"brain-{brain_id}"
+
+
+def surrogate_headers(brain_id, node_ids, shared=True, focus=None):
+    """Caching headers for a response showing these nodes (about `focus`).
+    Unless `shared`, only the browser may keep it, not the proxy."""
+    if not shared:
+        return {'Cache-Control': f'private, max-age={browser_max_age}'}
+    keys = " ".join([brain_key(brain_id)] + sorted(node_ids))
+    max_age = proxy_max_age
+    if len(keys) > surrogate_key_max:
+        # too many to list: changes of the other nodes do not purge it, so keep it briefly
+        keys = " ".join([brain_key(brain_id)] + ([focus] if focus else []))
+        max_age = browser_max_age
+    return {
+        'Cache-Control': f'public, max-age={browser_max_age}',
+        'Surrogate-Control': f'max-age={max_age}',
+        'Surrogate-Key': keys,
+    }
+
+
+class Purger:
+    """Asks the fronting proxy to drop responses showing written nodes.
+    Keys written within `delay` seconds are sent together."""
+
+    def __init__(self, url, method='PURGE', delay=0.5, max_keys=200):
+        self.url = url
+        self.method = method
+        self.delay = delay
+        self.max_keys = max_keys
+        self.pending = set()
+        self.task = None
+        self.client = httpx.AsyncClient(timeout=httpx.Timeout(5.0))
+
+    def __call__(self, brain_id, nodes, links=(), attachments=(), brain=False):
+        self.pending.update(nodes)
+        if brain:
+            self.pending.add(brain_key(brain_id))
+        if self.task is None:
+            self.task = spawn(self.flush_later())
+
+    async def flush_later(self):
+        await asyncio.sleep(self.delay)
+        keys, self.pending = sorted(self.pending), set()
+        self.task = None
+        await self.purge(keys)
+
+    async def purge(self, keys):
+        "Ask the proxy to drop the responses with these surrogate keys, now."
+        for i in range(0, len(keys), self.max_keys):
+            try:
+                r = await self.client.request(
+                    self.method, self.url,
+                    headers={'Surrogate-Key': " ".join(keys[i:i + self.max_keys])})
+                r.raise_for_status()
+            except httpx.HTTPError:
+                exception(f"Could not purge {len(keys)} keys")
+
+
+purge_url = mbconfig.get('purge_url', None)
+purger = Purger(purge_url, mbconfig.get('purge_method', 'PURGE')) if purge_url else None
+if purger:
+    # only for writes made by this process, so each write is purged once;
+    # processes that write without publishing, like the importer, purge themselves
+    on_publish(purger)
@@ -0,0 +1,266 @@
+from collections import defaultdict
+
+from sqlalchemy import union_all, any_, bindparam
+from sqlalchemy.dialects.postgresql import ARRAY, UUID
+from sqlalchemy.future import select
+from sqlalchemy.orm import aliased
+from sqlalchemy.sql import func, literal
+
+from .models import Node, Link, LinkRelation
+from .graph_index import graph_index
+
+# BrainIndex relation -> what the neighbour is to the thought
+INDEX_RELATIONS = {
+    'children': 'child', 'parents': 'parent', 'jumps_out': 'jump', 'jumps_in': 'jump',
+    'tags': 'tag', 'tagged': 'of_tag'}
+INVERSE = dict(child='parent', parent='child', jump='jump', tag='of_tag', of_tag='tag')
+RELATIONS = tuple(INVERSE)
+# ids per IN (...) list
+CHUNK_SIZE = 5000
+
+
+def index_expander(index, private=False, relations=RELATIONS):
+    """Neighbours of a frontier from a BrainIndex: {id: [(neighbour id, relation)]},
+    only those in `within` if given."""
+    followed = {name: relation for (name, relation) in INDEX_RELATIONS.items()
+                if relation in relations}
+
+    def visible(j):
+        info = index.info(j)
+        return info is not None and (private or not info[1])
+
+    async def expand(frontier, within=None):
+        result = {}
+        for id in frontier:
+            i = index.index.get(id, None)
+            if i is None:
+                continue
+            result[id] = [
+                (index.ids[j], relation)
+                for (name, relation) in followed.items()
+                for j in index.related(i, name)
+                if (within is None or index.ids[j] in within) and visible(j)]
+        return result
+    return expand
+
+
+def neighbours_query(brain_id, ids, private=False, relations=RELATIONS, within=None):
+    """(thought, neighbour, relation) rows of the thoughts `ids`, in one statement;
+    only neighbours in `within`, if given (sent as one array)."""
+    target = aliased(Node)
+    queries = []
+    for (jump, forward, backward) in ((False, 'child', 'parent'), (True, 'jump', 'jump')):
+        kind = (Link.relation == LinkRelation.Jump) if jump else (Link.relation != LinkRelation.Jump)
+        if forward in relations:
+            queries.append(select(Link.parent_id, Link.child_id, literal(forward)).join(
+                target, target.id == Link.child_id).filter(
+                Link.brain_id == brain_id, Link.parent_id.in_(ids), kind))
+        if backward in relations:
+            queries.append(select(Link.child_id, Link.parent_id, literal(backward)).join(
+                target, target.id == Link.parent_id).filter(
+                Link.brain_id == brain_id, Link.child_id.in_(ids), kind))
+    if 'tag' in relations:
+        tags = select(Node.id.label('id'), func.unnest(Node.tags).label('tag_id')).filter(
+            Node.brain_id == brain_id, Node.id.in_(ids)).subquery()
+        queries.append(select(tags.c.id, tags.c.tag_id, literal('tag')).join(
+            target, target.id == tags.c.tag_id))
+    if not private:
+        queries = [query.filter(target.private == False) for query in queries]
+    if within is not None:
+        within = bindparam('within', sorted(within), type_=ARRAY(UUID))
+        queries = [query.filter(target.id == any_(within)) for query in queries]
+    if 'of_tag' in relations:
+        tagged = select(func.unnest(Node.tags).label('tag_id'), Node.id.label('id')).filter(
+            Node.brain_id == brain_id, Node.tags.overlap(ids))
+        if not private:
+            tagged = tagged.filter(Node.private == False)
+        if within is not None:
+            tagged = tagged.filter(Node.id == any_(within))
+        tagged = tagged.subquery()
+        queries.append(select(tagged.c.tag_id, tagged.c.id, literal('of_tag')).filter(
+            tagged.c.tag_id.in_(ids)))
+    return union_all(*queries)
+
+
+def sql_expander(session, brain_id, private=False, relations=RELATIONS):
+    "Neighbours of a frontier (in `within` if given) with one statement per CHUNK_SIZE thoughts."
+    async def expand(frontier, within=None):
+        result = defaultdict(list)
+        frontier = list(frontier)
+        for start in range(0, len(frontier), CHUNK_SIZE):
+            ids = frontier[start:start + CHUNK_SIZE]
+            for (id, neighbour, relation) in await session.execute(
+                    neighbours_query(brain_id, ids, private, relations, within)):
+                result[id].append((neighbour, relation))
+        return result
+    return expand
+
+
+async def shortest_path(expand, source, target, max_depth=8, max_visited=200000):
+    """Bidirectional breadth-first search, expanding the smaller frontier each time.
+    Returns the thought ids of the path and what each is to the one before, or None."""
+    if source == target:
+        return [source], []
+    # id -> (previous id, what id is to it, depth), from each end
+    visited = ({source: (None, None, 0)}, {target: (None, None, 0)})
+    frontiers = ([source], [target])
+    for _ in range(max_depth):
+        if not frontiers[0] or not frontiers[1]:
+            return None
+        side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+        seen, other = visited[side], visited[1 - side]
+        next_frontier = []
+        meets = []
+        for (id, neighbours) in (await expand(frontiers[side])).items():
+            depth = seen[id][2] + 1
+            for (neighbour, relation) in neighbours:
+                if neighbour in seen:
+                    continue
+                seen[neighbour] = (id, relation, depth)
+                next_frontier.append(neighbour)
+                if neighbour in other:
+                    meets.append(neighbour)
+        if meets:
+            meet = min(meets, key=lambda id: other[id][2])
+            return join_path(visited, meet)
+        if len(visited[0]) + len(visited[1]) > max_visited:
+            return None
+        frontiers = (next_frontier, frontiers[1]) if side == 0 else (frontiers[0], next_frontier)
+    return None
+
+
+def join_path(visited, meet):
+    forward, backward = visited
+    path, relations = [meet], []
+    id = meet
+    while forward[id][0] is not None:
+        previous, relation, _ = forward[id]
+        path.insert(0, previous)
+        relations.insert(0, relation)
+        id = previous
+    id = meet
+    while backward[id][0] is not None:
+        next_id, relation, _ = backward[id]
+        path.append(next_id)
+        relations.append(INVERSE[relation])
+        id = next_id
+    return path, relations
+
+
+async def find_path(session, brain, source, target, max_depth=8, private=False):
+    """The shortest path between two thoughts over parent/child, jump and tag relations,
+    through public thoughts only unless `private`. None if either thought is not
+    known (or private), {} if there is no path within max_depth steps."""
+    index = graph_index.get(brain.id) if graph_index else None
+    names = await thought_names(session, brain.id, index, [source, target], private)
+    if source not in names or target not in names:
+        return None
+    expand = expander(session, brain.id, index, private)
+    found = await shortest_path(expand, source, target, max_depth)
+    if not found:
+        return {}
+    path, relations = found
+    names = await thought_names(session, brain.id, index, path, private)
+    return dict(
+        length=len(relations),
+        path=[dict(id=id, name=names.get(id), relation=relation)
+              for (id, relation) in zip(path, [None] + relations)])
+
+
+def expander(session, brain_id, index, private=False, relations=RELATIONS):
+    if index:
+        return index_expander(index, private, relations)
+    return sql_expander(session, brain_id, private, relations)
+
+
+def link_of(id, neighbour, relation):
+    "A link as (source, target, relation): parents point to children, and tagged thoughts to tags."
+    if relation == 'parent':
+        return (neighbour, id, 'child')
+    if relation == 'of_tag':
+        return (neighbour, id, 'tag')
+    if relation == 'jump' and neighbour < id:
+        # undirected here; one link for both ends
+        return (neighbour, id, relation)
+    return (id, neighbour, relation)
+
+
+async def subgraph(session, brain, root, depth=2, limit=500, fanout=50,
+                   relations=RELATIONS, private=False):
+    """The thoughts within `depth` steps of `root`, found level by level, and all the
+    links between them. Each thought contributes at most `fanout` neighbours (it is then
+    marked `truncated`), and the whole graph at most `limit` thoughts.
+    None if root is not known (or private)."""
+    index = graph_index.get(brain.id) if graph_index else None
+    if root not in await thought_names(session, brain.id, index, [root], private):
+        return None
+    expand = expander(session, brain.id, index, private, relations)
+    levels = {root: 0}
+    links = set()
+    truncated = set()
+    frontier = [root]
+    for level in range(1, depth + 1):
+        if not frontier or len(levels) >= limit:
+            break
+        next_frontier = []
+        for (id, neighbours) in (await expand(frontier)).items():
+            neighbours = sorted(set(neighbours), key=lambda n: (RELATIONS.index(n[1]), n[0]))
+            if len(neighbours) > fanout:
+                truncated.add(id)
+                neighbours = neighbours[:fanout]
+            for (neighbour, relation) in neighbours:
+                if neighbour not in levels:
+                    if len(levels) >= limit:
+                        truncated.add(id)
+                        break
+                    levels[neighbour] = level
+                    next_frontier.append(neighbour)
+                links.add(link_of(id, neighbour, relation))
+        frontier = next_frontier
+    # the links among the thoughts found that the expansion did not follow:
+    # from the last level, or beyond the fanout or the limit
+    rest = frontier + sorted(truncated)
+    if rest:
+        for (id, neighbours) in (await expand(rest, levels)).items():
+            links.update(link_of(id, neighbour, relation) for (neighbour, relation) in neighbours)
+    names = await thought_names(session, brain.id, index, list(levels), private)
+    return dict(
+        root=root,
+        nodes=[dict(id=id, name=names.get(id), level=level, **(
+            dict(truncated=True) if id in truncated else {}))
+            for (id, level) in levels.items()],
+        links=sorted(links))
+
+
+async def thought_names(session, brain_id, index, ids, private=False):
+    if index:
+        names = {}
+        for id in ids:
+            info = index.info(index.index[id]) if id in index.index else None
+            if info and (private or not info[1]):
+                names[id] = info[0]
+        return names
+    names = {}
+    for start in range(0, len(ids), CHUNK_SIZE):
+        query = select(Node.id, Node.name).filter(
+            Node.brain_id == brain_id, Node.id.in_(ids[start:start + CHUNK_SIZE]))
+        if not private:
+            query = query.filter(Node.private == False)
+        names.update((await session.execute(query)).all())
+    return names
+
+
+async def neighbour_summaries(session, brain, ids, relations=('parent', 'child', 'jump', 'tag'),
+                              private=False):
+    "{id: {relation: [[id, name], ...]}} of the neighbours of these thoughts, in a few statements."
+    index = graph_index.get(brain.id) if graph_index else None
+    found = await expander(session, brain.id, index, private, relations)(ids)
+    names = await thought_names(session, brain.id, index, list(
+        {neighbour for neighbours in found.values() for (neighbour, relation) in neighbours}), private)
+    summaries = {}
+    for (id, neighbours) in found.items():
+        by_relation = summaries.setdefault(id, {})
+        for (neighbour, relation) in sorted(set(neighbours), key=lambda n: names.get(n[0]) or ''):
+            if neighbour in names:
+                by_relation.setdefault(relation, []).append([neighbour, names[neighbour]])
+    return summaries
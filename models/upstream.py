@@ -0,0 +1,162 @@
+import asyncio
+from random import uniform
+from time import monotonic
+
+import httpx
+
+from .limits import TokenBucket
+
+
+class UpstreamUnavailable(Exception):
+    "TheBrain's API cannot answer now; use cached data if there is any."
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class AdaptiveLimiter:
+    """Caps concurrent upstream requests, with additive increase while latency
+    stays under target and multiplicative decrease when it does not (AIMD)."""
+
+    def __init__(self, initial=8, minimum=1, maximum=64, target=2.0, decrease=0.5, max_waiting=200):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target = target
+        self.decrease = decrease
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.waiting = 0
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        if self.waiting >= self.max_waiting:
+            raise UpstreamUnavailable("Too many pending upstream requests")
+        self.waiting += 1
+        try:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+                self.in_flight += 1
+        finally:
+            self.waiting -= 1
+
+    async def __aexit__(self, *exc):
+        async with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def record(self, latency, ok):
+        if ok and latency <= self.target:
+            self.limit = min(self.maximum, self.limit + 1 / self.limit)
+        else:
+            self.limit = max(self.minimum, self.limit * self.decrease)
+
+
+class CircuitBreaker:
+    """Opens after `threshold` consecutive failures; after `reset_timeout`
+    seconds a single probe request is let through (half-open)."""
+
+    def __init__(self, threshold=5, reset_timeout=30.0):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return 'closed'
+        if monotonic() - self.opened_at < self.reset_timeout:
+            return 'open'
+        return 'half-open'
+
+    def allow(self):
+        state = self.state
+        if state == 'closed':
+            return True
+        if state == 'half-open' and not self.probing:
+            self.probing = True
+            return True
+        return False
+
+    def record(self, ok):
+        self.probing = False
+        if ok:
+            self.failures = 0
+            self.opened_at = None
+        else:
+            self.failures += 1
+            if self.failures >= self.threshold or self.opened_at is not None:
+                self.opened_at = monotonic()
+
+
+class UpstreamClient:
+    "An httpx client for api.thebrain.com with load shedding, rate limits, retries and a circuit breaker."
+
+    def __init__(self, client, limiter=None, breaker=None, rate=10.0, burst=20,
+                 retries=2, backoff=0.5, max_wait=10.0):
+        self.client = client
+        self.limiter = limiter or AdaptiveLimiter()
+        self.breaker = breaker or CircuitBreaker()
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_wait = max_wait
+        self.buckets = {}
+
+    def available(self):
+        return self.breaker.state != 'open'
+
+    def bucket(self, brain_id):
+        if brain_id not in self.buckets:
+            self.buckets[brain_id] = TokenBucket(self.rate, self.burst)
+        return self.buckets[brain_id]
+
+    def retry_delay(self, attempt, response=None):
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(float(retry_after), self.max_wait)
+        # full jitter
+        return uniform(0, self.backoff * 2 ** attempt)
+
+    async def get(self, url, brain_id=None, **kwargs):
+        if not self.breaker.allow():
+            raise CircuitOpenError(url)
+        try:
+            await asyncio.wait_for(self.bucket(brain_id).acquire(), self.max_wait)
+        except asyncio.TimeoutError:
+            self.breaker.probing = False
+            raise UpstreamUnavailable(f"Rate limited: {url}")
+        response = None
+        for attempt in range(self.retries + 1):
+            if attempt:
+                await asyncio.sleep(self.retry_delay(attempt - 1, response))
+            try:
+                async with self.limiter:
+                    start = monotonic()
+                    try:
+                        response = await self.client.get(url, **kwargs)
+                    except httpx.TransportError:
+                        self.limiter.record(monotonic() - start, False)
+                        response = None
+                        continue
+                    ok = response.status_code != 429 and response.status_code < 500
+                    self.limiter.record(monotonic() - start, ok)
+            except UpstreamUnavailable:
+                self.breaker.probing = False
+                raise
+            if ok:
+                self.breaker.record(True)
+                return response
+        self.breaker.record(False)
+        raise UpstreamUnavailable(f"{url}: {response.status_code if response is not None else 'no response'}")
+
+    def metrics(self):
+        return dict(
+            concurrency_limit=self.limiter.limit,
+            in_flight=self.limiter.in_flight,
+            waiting=self.limiter.waiting,
+            breaker=self.breaker.state)
@@ -1,59 +1,156 @@
+import asyncio
 from configparser import ConfigParser
+from os import stat
 from os.path import join, dirname
 import simplejson as json
 from datetime import timedelta, datetime
+from logging import exception
 import re
 import base64
 import uuid
 
 from sqlalchemy.future import create_engine
 from sqlalchemy.ext.asyncio import create_async_engine
-from sqlalchemy.orm import sessionmaker, subqueryload, joinedload
+from sqlalchemy.orm import sessionmaker, subqueryload, joinedload, selectinload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.future import select
+from sqlalchemy import update, inspect, text
+from sqlalchemy.schema import CreateColumn
 import httpx
 from markdown import markdown
 
-from . import BRAIN_API
+from . import BRAIN_API, mbconfig
 from .models import AttachmentType, Node, Brain, Link, Attachment
+from .cache import invalidate, on_invalidate, on_clear, publish_in_transaction
+from .upstream import UpstreamClient, AdaptiveLimiter, CircuitBreaker, UpstreamUnavailable
+from .write_behind import WriteBehind
+from .routing import routing_session_maker, for_brain
+from .limits import admission, Overloaded
+from .bulk import as_values, upsert, count_written_links, lock_nodes, INSERTED, NODE_LOCAL_COLUMNS
 
 CONFIG_BRAINS = None
+# connections each async engine keeps open, and may open beyond those
+pool_size = mbconfig.getint('db_pool_size', 5)
+max_overflow = mbconfig.getint('db_max_overflow', 10)
+CONFIG_BRAINS_MTIME = None
+# slug and id -> detached Brain; the brain table hardly ever changes
+BRAIN_CACHE = {}
 timeout = httpx.Timeout(5.0, read=20.0)
-httpx_client = httpx.AsyncClient(timeout=timeout)
-
-async def get_thought_data(brain_id, thought_id, graph=True):
+# one pool of keep-alive connections, multiplexed over HTTP/2 where possible
+httpx_client = httpx.AsyncClient(
+    timeout=timeout, http2=mbconfig.getboolean('upstream_http2', True),
+    limits=httpx.Limits(
+        max_connections=mbconfig.getint('upstream_connections', 100),
+        max_keepalive_connections=mbconfig.getint('upstream_keepalive_connections', 20),
+        keepalive_expiry=mbconfig.getfloat('upstream_keepalive_expiry', 60.0)))
+upstream = UpstreamClient(
+    httpx_client,
+    AdaptiveLimiter(
+        initial=mbconfig.getint('upstream_concurrency', 8),
+        maximum=mbconfig.getint('upstream_max_concurrency', 64),
+        target=mbconfig.getfloat('upstream_target_latency', 2.0)),
+    CircuitBreaker(
+        threshold=mbconfig.getint('upstream_breaker_threshold', 5),
+        reset_timeout=mbconfig.getfloat('upstream_breaker_reset', 30.0)),
+    rate=mbconfig.getfloat('upstream_rate', 10.0),
+    retries=mbconfig.getint('upstream_retries', 2))
+# serve stale nodes and refresh them in the background, up to hard_staleness (days)
+stale_while_revalidate = mbconfig.getboolean('stale_while_revalidate', True)
+hard_staleness = timedelta(days=mbconfig.getfloat('hard_staleness', 7))
+SESSION_MAKER = None
+BACKGROUND_TASKS = set()
+
+# returned by get_thought_data when the thought did not change upstream
+NOT_MODIFIED = object()
+
+
+def conditional_headers(etag=None, last_modified=None):
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+async def get_thought_data(brain_id, thought_id, graph=True, etag=None, last_modified=None):
+    """The thought's data, or NOT_MODIFIED if it still matches the given validators,
+    with the response's validators (upstream_etag, upstream_last_modified)."""
     base = f"https://api.thebrain.com/{BRAIN_API}/brains/{brain_id}/thoughts/{thought_id}"
     if graph:
-        r = await httpx_client.get(base + "/graph")
+        r = await upstream.get(base + "/graph", brain_id=brain_id,
+                               headers=conditional_headers(etag, last_modified))
+        validators = dict(
+            upstream_etag=r.headers.get('ETag', None),
+            upstream_last_modified=r.headers.get('Last-Modified', None))
+        if r.status_code == 304:
+            return NOT_MODIFIED, validators
         if r.is_success:
             try:
-                return r.json()
+                return r.json(), validators
             except Exception as e:
                 pass
+        return None, {}
     else:
-        r1 = await httpx_client.get(base + "/note")
+        r1 = await upstream.get(base + "/note", brain_id=brain_id)
         if not r1.is_success:
-            return None
-        r2 = await httpx_client.get(base)
+            return None, {}
+        r2 = await upstream.get(base, brain_id=brain_id)
         if not r2.is_success:
-            return None
+            return None, {}
         try:
             r1 = r1.json()
             r2 = r2.json()
         except Exception as e:
-            return None
+            return None, {}
         return {
             # TODO
-        }
+        }, {}
 
 def get_config_brains():
-    global CONFIG_BRAINS
-    if CONFIG_BRAINS is None:
-        with open(join(dirname(dirname(__file__)), 'brains.json')) as f:
+    global CONFIG_BRAINS, CONFIG_BRAINS_MTIME
+    path = join(dirname(dirname(__file__)), 'brains.json')
+    mtime = stat(path).st_mtime
+    if CONFIG_BRAINS is None or mtime != CONFIG_BRAINS_MTIME:
+        with open(path) as f:
             CONFIG_BRAINS = json.load(f)
+        CONFIG_BRAINS_MTIME = mtime
+        BRAIN_CACHE.clear()
     return CONFIG_BRAINS
 
 
+def cache_brain(brain):
+    # keep a detached copy, so it is safe to merge into any session
+    copy = Brain(**{col.key: getattr(brain, col.key) for col in Brain.__table__.columns})
+    make_transient_to_detached(copy)
+    BRAIN_CACHE[brain.id] = copy
+    if brain.slug:
+        BRAIN_CACHE[brain.slug] = copy
+
+
+def uncache_brain(id):
+    for key, brain in list(BRAIN_CACHE.items()):
+        if brain.id == id:
+            del BRAIN_CACHE[key]
+
+
+@on_invalidate
+def _brain_changed(brain_id, nodes, links, attachments, brain=False):
+    if brain:
+        uncache_brain(brain_id)
+
+
+on_clear(BRAIN_CACHE.clear)
+
+
+async def load_brain_cache(session):
+    get_config_brains()
+    BRAIN_CACHE.clear()
+    for (brain,) in await session.execute(select(Brain)):
+        cache_brain(brain)
+
+
 UUID_S = \
     r'[0-9a-f]{8}\-[0-9a-f]{4}\-[0-9a-f]{4}\-[0-9a-f]{4}\-[0-9a-f]{12}'
 UUID_B64 = r'[-_A-Za-z0-9]{22}'
@@ -101,31 +198,41 @@ def extract_text_links_from_data(data):
 async def get_brain(session, slug):
     global CONFIG_BRAINS
     get_config_brains()
+    brain = BRAIN_CACHE.get(slug, None)
+    if brain is not None:
+        return for_brain(session, await session.merge(brain, load=False))
     if UUID_RE.match(slug):
         brain_data = [b for b in CONFIG_BRAINS.values()
                         if b['brain'] == slug]
         brain = await session.scalar(select(Brain).filter_by(id=slug))
-        if not brain:
-            if brain_data:
-                brain_data = brain_data[0]
-                brain = await add_brain(session, brain_data['brain'], slug,
-                                    brain_data['name'], brain_data.get('thought', None))
-            else:
-                brain = await add_brain(session, slug)
+        if brain:
+            cache_brain(brain)
+        elif brain_data:
+            brain_data = brain_data[0]
+            brain = await add_brain(session, brain_data['brain'], slug,
+                                brain_data['name'], brain_data.get('thought', None))
+        else:
+            brain = await add_brain(session, slug)
     else:
         brain = await session.scalar(select(Brain).filter_by(slug=slug))
         brain_data = CONFIG_BRAINS.get(slug, None)
-        if brain_data and not brain:
+        if brain:
+            cache_brain(brain)
+        elif brain_data:
             brain = await add_brain(session, brain_data['brain'], slug,
                                 brain_data['name'], brain_data.get('thought', None))
-    return brain
+    return for_brain(session, brain)
 
 
 async def add_brain(session, id, slug=None, name=None, base_id=None):
     global BRAINS
     brain = Brain(id=id, name=name, base_id=base_id, slug=slug)
     session.add(brain)
+    await publish_in_transaction(session, id, brain=True)
     await session.commit()
+    invalidate(id, brain=True, publish=False)
+    # the committed instance may be expired; cache an equivalent one
+    cache_brain(Brain(id=id, name=name, base_id=base_id, slug=slug))
     return brain
 
 
@@ -143,9 +250,13 @@ def engine_from_config(_async=True):
     url = config['memebrane']['dburl']
     if not _async:
         return create_engine(url)
+    return async_engine(url)
+
+
+def async_engine(url):
     if url.startswith('postgresql:'):
         url = url[:10] + '+asyncpg' + url[10:]
-    return create_async_engine(url)
+    return create_async_engine(url, pool_size=pool_size, max_overflow=max_overflow)
 
 
 def get_session_maker(engine=None, _async=True, **options):
@@ -156,6 +267,34 @@ def get_session(engine=None, _async=True, **options):
     smaker = get_session_maker(engine, _async, **options)
     return smaker()
 
+
+def shared_session_maker():
+    """The session maker of the web workers, also used by background tasks.
+    With replica_dburls, its sessions read from the replicas where they can."""
+    global SESSION_MAKER
+    if SESSION_MAKER is None:
+        replicas = mbconfig.get('replica_dburls', '').replace(',', ' ').split()
+        if replicas:
+            SESSION_MAKER = routing_session_maker(
+                engine_from_config(), [async_engine(url) for url in replicas],
+                lag=mbconfig.getfloat('replica_lag', 5.0), expire_on_commit=False)
+        else:
+            SESSION_MAKER = get_session_maker(expire_on_commit=False)
+    return SESSION_MAKER
+
+
+def spawn(coro):
+    "Run a coroutine in the background, keeping a reference until it is done."
+    task = asyncio.create_task(coro)
+    BACKGROUND_TASKS.add(task)
+    task.add_done_callback(BACKGROUND_TASKS.discard)
+    return task
+
+
+async def wait_background_tasks():
+    while BACKGROUND_TASKS:
+        await asyncio.gather(*BACKGROUND_TASKS, return_exceptions=True)
+
 def populate_brains(session, brains):
     for slug, brain_def in brains.items():
         brain = Brain(id=brain_def['brain'], name=brain_def['name'],
@@ -163,91 +302,288 @@ def populate_brains(session, brains):
         session.add(brain)
 
 
-async def add_to_cache(session, brain_id, data, force=False, graph=True):
+def attachment_content(adata, data, root_id, brain_id):
+    "The notes of the focus thought, as given inline in its graph data."
+    atype = adata.get("type", 0)
+    if atype == AttachmentType.NotesV9.value:
+        return convert_api_links(data["notesHtml"], root_id, brain_id)
+    elif atype == AttachmentType.InternalFile.value and adata.get("noteType", 0) == 4:
+        return convert_api_links(data["notesMarkdown"], root_id, brain_id)
+    # TODO: Should I get the attachment content from the link?
+
+
+def node_from_data(data):
+    """A transient Node for the focus of fresh graph data, with its attachments,
+    to render it before the write-behind queue has stored it."""
+    root_id = data['root']['id']
+    node_data = next((t for t in data['thoughts'] if t['id'] == root_id), None)
+    if node_data is None:
+        return None
+    node = Node.create_from_json(dict(node_data, tags=data.get('tags', [])), True)
+    atts = [Attachment.create_from_json(adata, attachment_content(adata, data, root_id, node.brain_id))
+            for adata in data.get('attachments', ()) if adata['sourceId'] == root_id]
+    set_committed_value(node, 'attachments', atts)
+    set_committed_value(node, 'html_attachments', [
+        a for a in atts if a.att_type == AttachmentType.NotesV9 and a.text_content is not None])
+    set_committed_value(node, 'md_attachments', [
+        a for a in atts if a.att_type == AttachmentType.InternalFile and a.location == "Notes.md"
+        and a.data.get('noteType') == 4 and a.text_content is not None])
+    set_committed_value(node, 'url_link_attachments', [
+        a for a in atts if a.att_type == AttachmentType.ExternalUrl])
+    return node
+
+
+async def add_to_cache(session, brain_id, data, force=False, graph=True, validators=None, commit=True):
+    """Store graph data, with one INSERT ... ON CONFLICT per table that leaves
+    unchanged rows alone. Returns the ids of what was written, as (nodes, links,
+    attachments); without `commit`, only flushes, and leaves publishing those ids,
+    the commit and invalidating them to the caller."""
     root_id = data['root']['id']
     nodes = {t['id']: t for t in data["thoughts"]}
     nodes.update({t['id']: t for t in data["tags"]})
-    node_ids = set(nodes.keys())
-    nodes_in_cache = await session.execute(select(Node).filter(
-        Node.id.in_(nodes.keys()), Node.brain_id==brain_id))
-    for (node,) in nodes_in_cache:
-        node_data = nodes.pop(node.id)
-        focus = node.id == root_id
-        if focus and 'tags' in data:
-            node_data['tags'] = data.get('tags', [])
-        node.update_from_json(node_data, focus, force)
+    rows = []
     for node_data in nodes.values():
         focus = node_data['id'] == root_id
         if focus:
-            node_data['tags'] = data.get('tags', [])
-        session.add(Node.create_from_json(
-            node_data, node_data['id'] == root_id))
-    await session.flush()
+            node_data = dict(node_data, tags=data.get('tags', []))
+        rows.append(as_values(Node.create_from_json(node_data, focus), NODE_LOCAL_COLUMNS - {'id'}))
+
     links = {l['id']: l for l in data.get("links", ())}
-    links_in_cache = await session.execute(select(Link).filter(
-        Link.id.in_(links.keys()), Link.brain_id==brain_id))
-    for (link,) in links_in_cache:
-        link_data = links.pop(link.id, None)
-        if link_data:
-            link.update_from_json(link_data, force)
-    for ldata in links.values():
-        if ldata['thoughtIdA'] in node_ids and ldata['thoughtIdB'] in node_ids:
-            session.add(Link.create_from_json(ldata))
-        else:
-            print(f"Missing node for this link:{ldata}")
-    attachments = {l['id']: l for l in data.get("attachments", ())}
-    attachments_in_cache = await session.execute(select(Attachment).filter(
-        Attachment.id.in_(attachments.keys())))
-    def get_content(adata, data):
-        content = None
-        atype = adata.get("type", 0)
-        if atype == AttachmentType.NotesV9.value:
-            return convert_api_links(data["notesHtml"], root_id, brain_id)
-        elif atype == AttachmentType.InternalFile.value and adata.get("noteType", 0) == 4:
-            return convert_api_links(data["notesMarkdown"], root_id, brain_id)
-        else:
-            # TODO: Should I get the attachment content from the link?
-            pass
-
-    for (attachment,) in attachments_in_cache:
-        adata = attachments.pop(attachment.id, None)
-        if adata:
-            attachment.update_from_json(
-                adata, get_content(adata, data), force=force)
+    missing = [l['id'] for l in links.values()
+               if l['thoughtIdA'] not in nodes or l['thoughtIdB'] not in nodes]
+    if missing:
+        # only update those, if we have them already
+        known = set(await session.scalars(select(Link.id).filter(
+            Link.id.in_(missing), Link.brain_id==brain_id)))
+        for id in missing:
+            if id not in known:
+                print(f"Missing node for this link:{links.pop(id)}")
+    # what the links were, for the stored link counts; locked until the commit
+    previous = {}
+    if links:
+        previous = {id: tuple(rest) for (id, *rest) in await session.execute(select(
+            Link.id, Link.parent_id, Link.child_id, Link.relation
+        ).filter(Link.id.in_(sorted(links))).order_by(Link.id).with_for_update())}
+    adatas = {a['id']: a for a in data.get("attachments", ())}
+    # every node written, or referenced by what is written, is locked at once in id
+    # order before any write: overlapping refreshes then wait rather than deadlock
+    await lock_nodes(session, set(nodes).union(
+        *((l['thoughtIdA'], l['thoughtIdB']) for l in links.values()),
+        *((parent_id, child_id) for (parent_id, child_id, _) in previous.values()),
+        (a['sourceId'] for a in adatas.values())))
+    written_nodes = {id for (id,) in await upsert(session, Node.__table__, rows, force)}
+    written_links = await upsert(
+        session, Link.__table__, [as_values(Link.create_from_json(l)) for l in links.values()],
+        force, ('id', 'parent_id', 'child_id', 'relation', INSERTED))
+    await count_written_links(session, brain_id, previous, written_links)
+
+    attachments = [
+        as_values(Attachment.create_from_json(adata, attachment_content(adata, data, root_id, brain_id)))
+        for adata in adatas.values()]
     # TODO: Should I delete absent attachments? only if graph of course
-    for adata in attachments.values():
-        session.add(Attachment.create_from_json(adata, get_content(adata, data)))
+    written_attachments = await upsert(
+        session, Attachment.__table__, attachments, force, ('id', 'node_id'))
+
+    # the focus was read now, even if nothing changed
+    await session.execute(update(Node).filter_by(
+        id=root_id, brain_id=brain_id).values(last_read=datetime.now(), **(validators or {})))
+    # pages showing a changed link or attachment show its nodes
+    for (id, parent_id, child_id, *_) in written_links:
+        written_nodes.update((parent_id, child_id))
+    written_nodes.update(node_id for (id, node_id) in written_attachments)
+    touched = (written_nodes, [id for (id, *_) in written_links],
+               [id for (id, _) in written_attachments])
+    if not commit:
+        await session.flush()
+        return touched
+    await publish_in_transaction(session, brain_id, *touched)
     await session.commit()
+    invalidate(brain_id, *touched, publish=False)
+    return touched
+
+
+# stores fetched graph data after the response, in batches
+cache_writer = WriteBehind(
+    add_to_cache, shared_session_maker,
+    max_pending=mbconfig.getint('write_behind_max_pending', 500),
+    batch_size=mbconfig.getint('write_behind_batch_size', 50),
+) if mbconfig.getboolean('write_behind', True) else None
+
 
+# (brain_id, thought_id) -> future of the upstream data, shared by concurrent misses
+IN_FLIGHT = {}
 
-async def get_node(session, brain, id, cache_staleness=timedelta(days=1), force=False, graph=True):
-    node = await session.scalar(
-        select(Node).filter_by(id=id, brain_id=brain.id).options(
+
+async def refresh_node(session, brain_id, id, force=False, graph=True, write_behind=False):
+    """Fetch a thought upstream and add it to the cache, once for all concurrent callers.
+    With `write_behind`, the data is queued for cache_writer instead of stored now.
+    Returns the upstream data and whether this caller was the one who fetched it."""
+    key = (brain_id, id)
+    while (future := IN_FLIGHT.get(key, None)) is not None:
+        try:
+            return await asyncio.shield(future), False
+        except asyncio.CancelledError:
+            if not future.cancelled():
+                raise
+            # the fetching request went away; try again ourselves
+    future = asyncio.get_running_loop().create_future()
+    IN_FLIGHT[key] = future
+    try:
+        etag = last_modified = None
+        if not force:
+            row = (await session.execute(select(
+                Node.upstream_etag, Node.upstream_last_modified).filter_by(
+                id=id, brain_id=brain_id, read_as_focus=True))).first()
+            if row:
+                etag, last_modified = row
+        data, validators = await get_thought_data(brain_id, id, graph, etag, last_modified)
+        if data is NOT_MODIFIED:
+            # still current: only note that we checked
+            data = None
+            await session.execute(update(Node).filter_by(
+                id=id, brain_id=brain_id).values(last_read=datetime.now()))
+            await session.commit()
+        elif data and write_behind and cache_writer:
+            await cache_writer.submit(brain_id, data, force, graph, validators)
+        elif data:
+            await add_to_cache(session, brain_id, data, force, graph, validators)
+        else:
+            # not visible upstream (anymore)
+            await session.execute(update(Node).filter_by(
+                id=id, brain_id=brain_id).values(private=True))
+            await publish_in_transaction(session, brain_id, [id])
+            await session.commit()
+            invalidate(brain_id, [id], publish=False)
+        future.set_result(data)
+        return data, True
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # waiters, if any, will get it; do not log it as unretrieved
+        raise
+    finally:
+        del IN_FLIGHT[key]
+
+
+def node_query(brain_id, id):
+    # links are not loaded: hubs have thousands. Neighbours are read a page at a time.
+    return select(Node).filter_by(id=id, brain_id=brain_id).options(
         joinedload(Node.html_attachments),
         joinedload(Node.md_attachments),
-        joinedload(Node.parent_links),
-        subqueryload(Node.child_links), 
         subqueryload(Node.attachments),
-        subqueryload(Node.url_link_attachments)))
+        subqueryload(Node.url_link_attachments))
+
+
+async def revalidate(brain_id, id, graph=True):
+    try:
+        async with shared_session_maker()() as session:
+            await refresh_node(session, brain_id, id, graph=graph)
+    except UpstreamUnavailable:
+        pass
+    except Exception:
+        exception(f"Could not refresh {brain_id}/{id}")
+
+
+async def get_node(session, brain, id, cache_staleness=timedelta(days=1), force=False, graph=True,
+                   write_behind=False):
+    node = await session.scalar(node_query(brain.id, id))
     data = None
+    if admission and admission.degraded:
+        # overloaded: serve only what we have
+        if not node:
+            raise Overloaded(f"{id} is not cached")
+        if force or not node.read_as_focus or (
+                cache_staleness is not None and datetime.now() - node.last_read > cache_staleness):
+            node.served_stale = True
+        return node, data
+    if node and node.read_as_focus and cache_staleness is not None and not force:
+        age = datetime.now() - node.last_read
+        if cache_staleness < age <= hard_staleness and stale_while_revalidate:
+            node.served_stale = True
+            if (brain.id, id) not in IN_FLIGHT and upstream.available():
+                spawn(revalidate(brain.id, id, graph))
+            return node, data
     if force or not node or cache_staleness is None or not node.read_as_focus or datetime.now() - node.last_read > cache_staleness:
-        data = await get_thought_data(brain.id, id, graph)
-        if data:
-            await add_to_cache(session, brain.id, data, force, graph)
+        try:
+            data, fetched = await refresh_node(session, brain.id, id, force, graph, write_behind)
+        except UpstreamUnavailable:
             if not node:
-                node = await session.scalar(select(Node).filter_by(
-                    id=id, brain_id=brain.id))
-        elif node:
-            node.private = True
-            await session.commit()
+                raise
+            # fall back on what we have
+            node.served_stale = True
+            return node, None
+        if data and write_behind and cache_writer:
+            fresh = node_from_data(data)
+            if fresh is not None:
+                return fresh, data
+        if cache_writer and cache_writer.is_pending(brain.id, id):
+            await cache_writer.wait_written(brain.id, id)
+            fetched = False
+        if not fetched or data:
+            # the cache was written by another request, or with statements
+            # that bypass the loaded objects; see the result
+            node = await session.scalar(node_query(brain.id, id).execution_options(
+                populate_existing=True))
     return node, data
 
 
+async def get_nodes(session, brain, ids, refresh=True, concurrency=8, max_refresh=100):
+    """The cached nodes of these ids, by id, with their notes and URL attachments,
+    in a constant number of queries. Up to `max_refresh` ids that are not cached,
+    or were never read as focus, are first fetched upstream, `concurrency` at a
+    time, each with its own session."""
+    query = select(Node).filter(Node.brain_id == brain.id, Node.id.in_(ids)).options(
+        selectinload(Node.html_attachments),
+        selectinload(Node.md_attachments),
+        selectinload(Node.url_link_attachments))
+    nodes = {node.id: node for node in await session.scalars(query)}
+    misses = [id for id in ids if id not in nodes or not nodes[id].read_as_focus][:max_refresh]
+    if not (refresh and misses and upstream.available()) or (admission and admission.degraded):
+        return nodes
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def fetch(id):
+        async with semaphore:
+            try:
+                async with shared_session_maker()() as own_session:
+                    await refresh_node(own_session, brain.id, id)
+                return id
+            except UpstreamUnavailable:
+                pass
+            except Exception:
+                exception(f"Could not refresh {brain.id}/{id}")
+
+    fetched = [id for id in await asyncio.gather(*[fetch(id) for id in misses]) if id]
+    if fetched:
+        nodes.update({node.id: node for node in await session.scalars(
+            query.filter(Node.id.in_(fetched)).execution_options(populate_existing=True))})
+    return nodes
+
+
 def create_tables(engine):
     with engine.connect() as conn:
         Node.metadata.create_all(conn)
 
 
+def upgrade_tables(engine):
+    """Add the columns of newer versions to tables created before them: create_all
+    only creates missing tables. Returns the columns added, as "table.column"."""
+    added = []
+    with engine.begin() as conn:
+        existing = inspect(conn)
+        for tbl in Node.metadata.sorted_tables:
+            if not existing.has_table(tbl.name):
+                continue
+            present = {col['name'] for col in existing.get_columns(tbl.name)}
+            for col in tbl.columns:
+                if col.name not in present:
+                    conn.execute(text(f"ALTER TABLE {tbl.name} ADD COLUMN {CreateColumn(col).compile(dialect=conn.dialect)}"))
+                    added.append(f"{tbl.name}.{col.name}")
+    return added
+
+
 def lcase1(str):
     if str[1].lower() == str[1]:
         return str[0].lower() + str[1:]
@@ -283,6 +619,14 @@ def html_to_markdown(html, flavour="markdown"):
 
 
 if __name__ == '__main__':
-    engine = get_engine()
+    # the schema is changed through a synchronous connection
+    engine = engine_from_config(_async=False)
     create_tables(engine)
-    populate_brains(get_session(engine), get_config_brains())
+    added = upgrade_tables(engine)
+    if added:
+        print("Added columns:", ", ".join(added))
+    if 'node.child_count' in added:
+        # the link counts start at 0: count them once
+        from .reader import repair_link_counts
+        print(asyncio.run(repair_link_counts()))
+    populate_brains(get_session(engine, _async=False), get_config_brains())
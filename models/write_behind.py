@@ -0,0 +1,130 @@
+import asyncio
+from collections import Counter, OrderedDict
+from logging import exception
+
+from .cache import invalidate, publish_in_transaction
+
+
+class WriteBehind:
+    """Stores upstream graph payloads in the background, off the request path.
+
+    Payloads wait in `pending`, keyed by (brain_id, root thought id); a newer
+    payload for the same thought replaces the queued one. The writer applies
+    up to `batch_size` payloads per transaction with
+    `apply(session, brain_id, data, force, graph, validators, commit=False)`,
+    which returns the ids it touched, and invalidates them after the commit.
+    Submitters wait while `max_pending` payloads are queued."""
+
+    def __init__(self, apply, sessions, max_pending=500, batch_size=50, delay=0.05):
+        self.apply = apply
+        self.sessions = sessions
+        self.max_pending = max_pending
+        self.batch_size = batch_size
+        self.delay = delay
+        self.pending = OrderedDict()
+        # keys being written, and futures of readers waiting for them
+        self.writing = set()
+        self.waiters = {}
+        self.condition = asyncio.Condition()
+        self.task = None
+        self.stopping = False
+        self.stats = Counter()
+
+    async def submit(self, brain_id, data, force=False, graph=True, validators=None):
+        key = (brain_id, data['root']['id'])
+        async with self.condition:
+            if key not in self.pending and len(self.pending) >= self.max_pending:
+                self.stats['backpressure'] += 1
+                await self.condition.wait_for(lambda: len(self.pending) < self.max_pending)
+            previous = self.pending.pop(key, None)
+            if previous:
+                self.stats['merged'] += 1
+                force = force or previous[1]
+                validators = validators or previous[3]
+            self.pending[key] = (data, force, graph, validators)
+            self.stats['submitted'] += 1
+            self.condition.notify_all()
+
+    def is_pending(self, brain_id, id):
+        key = (brain_id, id)
+        return key in self.pending or key in self.writing
+
+    async def wait_written(self, brain_id, id):
+        "Wait until a queued payload for this thought is in the database."
+        key = (brain_id, id)
+        if not self.is_pending(brain_id, id):
+            return
+        if key not in self.waiters:
+            self.waiters[key] = asyncio.get_running_loop().create_future()
+        await asyncio.shield(self.waiters[key])
+
+    async def write(self, session, batch):
+        touched = []
+        for ((brain_id, id), (data, force, graph, validators)) in batch:
+            touched.append((brain_id, await self.apply(
+                session, brain_id, data, force, graph, validators, commit=False)))
+        for (brain_id, (nodes, links, attachments)) in touched:
+            await publish_in_transaction(session, brain_id, nodes, links, attachments)
+        await session.commit()
+        return touched
+
+    async def write_batch(self):
+        async with self.condition:
+            batch = [self.pending.popitem(last=False)
+                     for _ in range(min(self.batch_size, len(self.pending)))]
+            self.writing.update(key for (key, item) in batch)
+            self.condition.notify_all()
+        touched = []
+        try:
+            async with self.sessions()() as session:
+                touched = await self.write(session, batch)
+        except Exception:
+            # one bad payload should not lose the others
+            for item in batch:
+                try:
+                    async with self.sessions()() as session:
+                        touched.extend(await self.write(session, [item]))
+                except Exception:
+                    self.stats['errors'] += 1
+                    exception(f"Could not store {item[0]}")
+        finally:
+            for (key, item) in batch:
+                self.writing.discard(key)
+                future = self.waiters.pop(key, None)
+                if future and not future.done():
+                    future.set_result(None)
+        for (brain_id, (nodes, links, attachments)) in touched:
+            invalidate(brain_id, nodes, links, attachments, publish=False)
+        self.stats['batches'] += 1
+        self.stats['written'] += len(touched)
+
+    async def run(self):
+        while True:
+            async with self.condition:
+                await self.condition.wait_for(lambda: self.pending or self.stopping)
+            if self.stopping and not self.pending:
+                return
+            if not self.stopping:
+                # let concurrent fetches join the batch
+                await asyncio.sleep(self.delay)
+            try:
+                await self.write_batch()
+            except Exception:
+                exception("Write-behind failed")
+
+    def start(self, spawn):
+        self.task = spawn(self.run())
+
+    async def stop(self):
+        "Stop the writer, storing whatever is still queued."
+        async with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.task:
+            await self.task
+            self.task = None
+        while self.pending:
+            await self.write_batch()
+
+    def metrics(self):
+        return dict(self.stats, pending=len(self.pending))
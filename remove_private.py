@@ -1,9 +1,70 @@
 import pathlib
+import re
+import shutil
+import tempfile
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 try:
   import simplejson as json
 except ImportError:
   import json
 
+# Cheap field extraction, so most lines never go through a JSON decoder
+ID_RE = re.compile(r'"Id"\s*:\s*"([^"]+)"')
+ACTYPE_RE = re.compile(r'"ACType"\s*:\s*(-?\d+)')
+SOURCE_RE = re.compile(r'"SourceId"\s*:\s*"([^"]+)"')
+THOUGHT_A_RE = re.compile(r'"ThoughtIdA"\s*:\s*"([^"]+)"')
+THOUGHT_B_RE = re.compile(r'"ThoughtIdB"\s*:\s*"([^"]+)"')
+# filtered files are kept in memory up to this size, then spooled to disk
+SPOOL_SIZE = 16 * 1024 * 1024
+
+
+def get_field(line, regex, key):
+  m = regex.search(line)
+  if m:
+    return m.group(1)
+  return json.loads(line).get(key, None)
+
+
+def node_privacy(line):
+  "(id, is_private) for a line of thoughts.json"
+  id = get_field(line, ID_RE, "Id")
+  if '"ACType"' not in line:
+    return id, False
+  m = ACTYPE_RE.search(line)
+  actype = int(m.group(1)) if m else json.loads(line).get("ACType", 0)
+  return id, actype == 1
+
+
+def keep_by_source(nodes):
+  return lambda line: get_field(line, SOURCE_RE, "SourceId") in nodes
+
+
+def keep_link(nodes):
+  return lambda line: get_field(line, THOUGHT_A_RE, "ThoughtIdA") in nodes \
+    and get_field(line, THOUGHT_B_RE, "ThoughtIdB") in nodes
+
+
+def filter_thoughts(f, f2):
+  "Copy public thoughts from f to f2. Returns the public and private node ids."
+  nodes = set()
+  private = set()
+  for line in f:
+    id, is_private = node_privacy(line)
+    if is_private:
+      private.add(id)
+      continue
+    nodes.add(id)
+    f2.write(line)
+  return nodes, private
+
+
+def filter_lines(f, f2, keep):
+  for line in f:
+    if line.strip() and keep(line):
+      f2.write(line)
+
+
 def del_dir(dir):
   for p in dir.iterdir():
     if p.is_dir():
@@ -12,55 +73,97 @@ def del_dir(dir):
       p.unlink()
   dir.rmdir()
 
+
 def remove_private(path):
-  nodes = set()
+  "Filter an extracted export directory in place"
   path = pathlib.Path(path)
-  p1 = path.joinpath("thoughts.json")
-  p2 = path.joinpath("_thoughts.json")
-  with p1.open() as f, p2.open('w') as f2:
+
+  def rewrite(name, filter, *args):
+    p1 = path.joinpath(name)
+    p2 = path.joinpath("_" + name)
+    if not p1.exists():
+      return None
+    with p1.open() as f, p2.open('w') as f2:
+      result = filter(f, f2, *args)
+    p1.unlink()
+    p2.rename(p1)
+    return result
+
+  nodes, private = rewrite("thoughts.json", filter_thoughts)
+  for id in private:
+    sub = path.joinpath(id)
+    if sub.exists():
+      print(sub)
+      del_dir(sub)
+  rewrite("attachments.json", filter_lines, keep_by_source(nodes))
+  rewrite("modificationlogs.json", filter_lines, keep_by_source(nodes))
+  rewrite("links.json", filter_lines, keep_link(nodes))
+
+
+def _filter_member(src, name, keep):
+  # each thread reads through its own handle on the archive
+  out = tempfile.SpooledTemporaryFile(SPOOL_SIZE, mode='w+b')
+  with zipfile.ZipFile(src) as zin, zin.open(name) as f:
+    for line in f:
+      if line.strip() and keep(line.decode('utf-8')):
+        out.write(line)
+  out.seek(0)
+  return out
+
+
+def remove_private_zip(src, dest, workers=3):
+  """Write a filtered copy of a zipped export, streaming each member once.
+  thoughts.json is read first, then the other json files are filtered in
+  parallel while the remaining members are copied."""
+  with zipfile.ZipFile(src) as zin, \
+      zipfile.ZipFile(dest, 'w', zipfile.ZIP_DEFLATED) as zout:
+    members = zin.infolist()
+    names = set(zin.namelist())
+    thoughts = [m for m in members if m.filename.rsplit('/', 1)[-1] == "thoughts.json"][0]
+    prefix = thoughts.filename[:-len("thoughts.json")]
+    with zin.open(thoughts) as f, tempfile.SpooledTemporaryFile(SPOOL_SIZE, mode='w+b') as out:
+      nodes = set()
+      private = set()
       for line in f:
-        node = json.loads(line)
-        id = node['Id']
-        if node.get("ACType", 0) == 1:
-          sub = path.joinpath(id)
-          if sub.exists():
-            print(sub)
-            del_dir(sub)
+        id, is_private = node_privacy(line.decode('utf-8'))
+        if is_private:
+          private.add(id)
+        else:
+          nodes.add(id)
+          out.write(line)
+      out.seek(0)
+      with zout.open(thoughts.filename, 'w', force_zip64=True) as f2:
+        shutil.copyfileobj(out, f2)
+    filters = {
+      prefix + "attachments.json": keep_by_source(nodes),
+      prefix + "modificationlogs.json": keep_by_source(nodes),
+      prefix + "links.json": keep_link(nodes),
+    }
+    with ThreadPoolExecutor(workers) as pool:
+      filtered = {
+        name: pool.submit(_filter_member, src, name, keep)
+        for (name, keep) in filters.items() if name in names}
+      for member in members:
+        name = member.filename
+        if member is thoughts or name in filters:
           continue
-        nodes.add(id)
-      f2.write(line)
-  p1.unlink()
-  p2.rename(p1)
-  p1 = path.joinpath("attachments.json")
-  p2 = path.joinpath("_attachments.json")
-  with p1.open() as f, p2.open('w') as f2:
-      for line in f:
-        attachment = json.loads(line)
-        if attachment["SourceId"] in nodes:
-          f2.write(line)
-  p1.unlink()
-  p2.rename(p1)
-  p1 = path.joinpath("modificationlogs.json")
-  p2 = path.joinpath("_modificationlogs.json")
-  with p1.open() as f, p2.open('w') as f2:
-      for line in f:
-        attachment = json.loads(line)
-        if attachment["SourceId"] in nodes:
-          f2.write(line)
-  p1.unlink()
-  p2.rename(p1)
-  p1 = path.joinpath("links.json")
-  p2 = path.joinpath("_links.json")
-  with p1.open() as f, p2.open('w') as f2:
-      for line in f:
-        link = json.loads(line)
-        if link["ThoughtIdA"] in nodes and link["ThoughtIdB"] in nodes:
-          f2.write(line)
-  p1.unlink()
-  p2.rename(p1)
+        top = name[len(prefix):].split('/', 1)[0]
+        if name.startswith(prefix) and top in private:
+          continue
+        if member.is_dir():
+          zout.writestr(member, b'')
+          continue
+        with zin.open(member) as f, zout.open(name, 'w', force_zip64=True) as f2:
+          shutil.copyfileobj(f, f2)
+      for name, future in filtered.items():
+        with future.result() as out, zout.open(name, 'w', force_zip64=True) as f2:
+          shutil.copyfileobj(out, f2)
+  print(f"Removed {len(private)} private thoughts")
 
 
 if __name__ == "__main__":
   from sys import argv
-  remove_private(argv[1])
-
+  if zipfile.is_zipfile(argv[1]):
+    remove_private_zip(argv[1], argv[2])
+  else:
+    remove_private(argv[1])